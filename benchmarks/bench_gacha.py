@@ -0,0 +1,97 @@
+"""ガチャ抽選のマイクロベンチマーク
+
+従来の1回ずつの random.choices と GachaEngine.bulk_pull を比較する．
+計測の前に，seed を固定した GachaEngine で以下を確認する．
+
+- 確定枠の位置 (10回ごと)
+- 結果の件数
+- 同じ seed での再現性
+- summarize() の件数と天井カウンター
+
+    python benchmarks/bench_gacha.py [--pulls 100000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+PULL_COUNTS = (0, 1, 9, 10, 11, 19, 20, 25, 100, 1005)
+SEEDS = range(20)
+
+def make_engine(seed):
+    return main.GachaEngine(
+        main.GACHA_ITEMS,
+        {'normal': main.GACHA_WEIGHTS_NORMAL, 'guaranteed': main.GACHA_WEIGHTS_GUARANTEED},
+        seed=seed,
+    )
+
+def expected_since_rare(categories):
+    """最後の★3より後に引いた回数を素朴に数える (★3が無ければNone)"""
+    for count, category in enumerate(reversed(categories)):
+        if category == main.GACHA_RARE_CATEGORY:
+            return count
+    return None
+
+def check_engine():
+    """GachaEngine の性質を確認し，問題の説明のリストを返す"""
+    problems = []
+    guaranteed_blocked = [i for i, weight in enumerate(main.GACHA_WEIGHTS_GUARANTEED) if weight == 0]
+    for seed in SEEDS:
+        for n in PULL_COUNTS:
+            categories = make_engine(seed).pull_categories(n)
+            if len(categories) != n:
+                problems.append(f"seed={seed} n={n}: {len(categories)} 件しか返らない")
+                continue
+            if categories != make_engine(seed).pull_categories(n):
+                problems.append(f"seed={seed} n={n}: 同じseedで結果が変わる")
+            # 10回ごとの確定枠 (9, 19, …番目) では確定枠で出ないカテゴリを引かない
+            for index in range(9, n, 10):
+                if categories[index] in guaranteed_blocked:
+                    problems.append(f"seed={seed} n={n}: {index}番目が確定枠になっていない")
+            counts, since_rare = make_engine(seed).summarize(categories)
+            if counts != [categories.count(c) for c in range(len(main.GACHA_ITEMS))]:
+                problems.append(f"seed={seed} n={n}: 件数が合わない {counts}")
+            if since_rare != expected_since_rare(categories):
+                problems.append(f"seed={seed} n={n}: 天井カウンター {since_rare} != {expected_since_rare(categories)}")
+
+    rare = main.GACHA_RARE_CATEGORY
+    engine = make_engine(0)
+    for categories, expected in (([], None), ([0, 1], None), ([rare], 0), ([rare, 0, 1], 2), ([0, rare, rare, 0], 1)):
+        _, since_rare = engine.summarize(categories)
+        if since_rare != expected:
+            problems.append(f"summarize({categories}): 天井カウンター {since_rare} != {expected}")
+    return problems
+
+def legacy_pulls(pulls, rng):
+    """変更前と同じく1回ずつ random.choices で引く"""
+    results = []
+    for i in range(pulls):
+        weights = main.GACHA_WEIGHTS_GUARANTEED if i % 10 == 9 else main.GACHA_WEIGHTS_NORMAL
+        category = rng.choices(main.GACHA_ITEMS, weights=weights)[0]
+        results.append(rng.choice(category))
+    return results
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pulls", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    problems = check_engine()
+    if problems:
+        print(f"GachaEngine の確認で {len(problems)} 件の問題があります: {problems[:3]}")
+        sys.exit(1)
+
+    rng = random.Random(0)
+    engine = make_engine(0)
+    for name, func in (("legacy per-pull", lambda: legacy_pulls(args.pulls, rng)), ("bulk_pull", lambda: engine.bulk_pull(args.pulls))):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f"{name:>16}: {best * 1e9 / args.pulls:8.0f} ns/pull ({args.pulls} pulls)")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,356 @@
+"""メディア処理の経路をローカルだけで動かす負荷ベンチマーク
+
+fxtwitter / phixiv / i.pixiv.re の代わりになるaiohttpサーバーを別スレッドで起動し，
+main.py の取得先をそこへ向けた上で，偽のDiscordオブジェクトに対して
+process_media_link / process_embed_images / on_raw_reaction_add を並行して実行する．
+シナリオごとに 件数/秒，レイテンシの p50/p99，最大RSS を表示する．
+RSSをシナリオごとに測れるよう，各シナリオは代替サーバーとは別の子プロセスで実行する．
+
+    python benchmarks/bench_media_path.py --messages 200 --concurrency 20 --latency-ms 30
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib
+import os
+import json
+import resource
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+
+SCENARIOS = ('twitter', 'pixiv', 'multilink', 'embed', 'reaction')
+RESULT_PREFIX = 'BENCH_RESULT '  # 子プロセスが結果を出力する行の目印
+PIXIV_EXTENSIONS = ('png', 'jpg', 'gif')
+BOT_USER_ID = 1
+CHANNEL_ID = 100
+
+# -----------------------------------------------------------------------------
+# 上流サーバーの代替
+# -----------------------------------------------------------------------------
+class UpstreamServer:
+    """fxtwitter / phixiv / pixiv画像サーバーのふりをするローカルサーバー
+
+    全ての応答を latency 秒遅らせ，画像は image_bytes バイトのダミーを返す．
+    missing_rate の割合の画像は全ての拡張子で404を返す．pixivの作品は
+    作品IDから決まる1つの拡張子だけが存在する．
+    """
+
+    def __init__(self, latency, image_bytes, images_per_post, missing_rate):
+        self.latency = latency
+        self.image = os.urandom(image_bytes)
+        self.images_per_post = images_per_post
+        self.missing_rate = missing_rate
+        self.requests = 0
+        self.base_url = None
+        self._loop = None
+        self._thread = None
+        self._runner = None
+
+    def _is_missing(self, key):
+        return zlib.crc32(key.encode()) % 1000 < self.missing_rate * 1000
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def fxtwitter(self, request):
+        await self._delay()
+        status_id = request.match_info['status_id']
+        media = [{'url': f"{self.base_url}/media/{status_id}_{k}.jpg"} for k in range(self.images_per_post)]
+        return web.json_response({'tweet': {'media': {'all': media}}})
+
+    async def phixiv(self, request):
+        await self._delay()
+        artwork_id = request.query['id']
+        proxy_urls = [
+            f"{self.base_url}/i/img-master/img/2024/01/01/00/00/00/{artwork_id}_p{k}_master1200.jpg"
+            for k in range(self.images_per_post)
+        ]
+        return web.json_response({'image_proxy_urls': proxy_urls})
+
+    async def media(self, request):
+        await self._delay()
+        name = request.match_info['name']
+        if self._is_missing(name):
+            return web.Response(status=404)
+        return web.Response(body=self.image, content_type='image/jpeg')
+
+    async def pixiv_original(self, request):
+        await self._delay()
+        illust_id, page, extension = request.match_info['illust_id'], request.match_info['page'], request.match_info['ext']
+        if extension != PIXIV_EXTENSIONS[int(illust_id) % len(PIXIV_EXTENSIONS)] or self._is_missing(f"{illust_id}_{page}"):
+            return web.Response(status=404)
+        return web.Response(body=self.image, content_type=f'image/{extension}')
+
+    async def _start(self, ready):
+        app = web.Application()
+        app.router.add_get('/fx/{user}/status/{status_id}', self.fxtwitter)
+        app.router.add_get('/phixiv/api/info', self.phixiv)
+        app.router.add_get('/media/{name}.jpg', self.media)
+        app.router.add_get(r'/pixiv/img-original/img/{date:[\d/]+}/{illust_id:\d+}_p{page:\d+}.{ext}', self.pixiv_original)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        ready.set()
+
+    def start(self):
+        """別スレッドのイベントループでサーバーを起動する (ボット側の計測を邪魔しないため)"""
+        ready = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.create_task(self._start(ready))
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+# -----------------------------------------------------------------------------
+# Discordオブジェクトの代替
+# -----------------------------------------------------------------------------
+class DeliverySink:
+    """送信されたファイルを読み捨て，件数とバイト数を数える"""
+
+    def __init__(self, upload_latency):
+        self.upload_latency = upload_latency
+        self.messages = 0
+        self.files = 0
+        self.bytes = 0
+
+    async def deliver(self, files):
+        self.messages += 1
+        for file in files or ():
+            self.files += 1
+            self.bytes += len(file.fp.read())
+            file.close()
+        if self.upload_latency:
+            await asyncio.sleep(self.upload_latency)
+
+class FakeUser:
+    def __init__(self, user_id, sink):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+        self._sink = sink
+
+    async def send(self, content=None, files=None, **kwargs):
+        await self._sink.deliver(files)
+
+class FakeChannel(discord.TextChannel):
+    """on_raw_reaction_add の isinstance チェックを通すための TextChannel (初期化はしない)"""
+
+    @classmethod
+    def create(cls, channel_id, sink):
+        channel = object.__new__(cls)
+        channel.id = channel_id
+        channel.name = f"channel{channel_id}"
+        channel._sink = sink
+        channel._messages = {}
+        return channel
+
+    async def send(self, content=None, files=None, **kwargs):
+        await self._sink.deliver(files)
+
+    async def fetch_message(self, message_id):
+        try:
+            return self._messages[message_id]
+        except KeyError:
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+
+class FakeMessage:
+    def __init__(self, message_id, content, author, channel, embeds=()):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = None
+        self.embeds = list(embeds)
+        self.reference = None
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def remove_reaction(self, emoji, member):
+        pass
+
+# -----------------------------------------------------------------------------
+# 計測
+# -----------------------------------------------------------------------------
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def peak_rss_mb():
+    # Linux の ru_maxrss はKB単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def build_jobs(main, scenario, count, channel, sink, offset, upstream):
+    """シナリオごとに，1件分の処理を行うコルーチン関数のリストを作る"""
+    jobs = []
+    for i in range(count):
+        message_id = offset + i
+        author = FakeUser(10_000 + i % 50, sink)
+        if scenario == 'twitter':
+            message = FakeMessage(message_id, f"見て https://x.com/someone/status/{message_id}", author, channel)
+            jobs.append(lambda message=message: main.process_media_link(message, 'twitter'))
+        elif scenario == 'pixiv':
+            message = FakeMessage(message_id, f"https://www.pixiv.net/artworks/{message_id}", author, channel)
+            jobs.append(lambda message=message: main.process_media_link(message, 'pixiv'))
+        elif scenario == 'multilink':
+            # 1メッセージにツイート2件 (うち1件は表記違いの重複) と pixiv 1件
+            content = (
+                f"https://x.com/someone/status/{message_id} https://twitter.com/someone/status/{message_id} "
+                f"https://x.com/other/status/{message_id + 1_000_000} https://www.pixiv.net/artworks/{message_id}"
+            )
+            message = FakeMessage(message_id, content, author, channel)
+            jobs.append(lambda message=message: main.process_media_link(message, 'twitter'))
+        elif scenario == 'embed':
+            embeds = [
+                SimpleNamespace(image=SimpleNamespace(url=f"{upstream}/media/embed{message_id}_{k}.jpg"))
+                for k in range(4)
+            ]
+            message = FakeMessage(message_id, "再送信", author, channel)
+            jobs.append(lambda message=message, embeds=embeds: main.process_embed_images(message, main.embed_image_url_groups(embeds)))
+        elif scenario == 'reaction':
+            original = FakeMessage(message_id, f"https://twitter.com/someone/status/{message_id}", FakeUser(20_000, sink), channel)
+            channel._messages[message_id] = original
+            payload = SimpleNamespace(
+                user_id=author.id, emoji='❤️', message_id=message_id, channel_id=channel.id, member=author,
+            )
+            jobs.append(lambda payload=payload: main.on_raw_reaction_add(payload))
+    return jobs
+
+async def run_scenario(main, scenario, args, offset):
+    sink = DeliverySink(args.upload_latency_ms / 1000)
+    channel = FakeChannel.create(CHANNEL_ID, sink)
+    main.bot.get_channel = lambda channel_id: channel if channel_id == CHANNEL_ID else None
+    jobs = build_jobs(main, scenario, args.messages, channel, sink, offset, args.upstream)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def run_one(job):
+        async with semaphore:
+            start = time.perf_counter()
+            await job()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        await asyncio.gather(*(run_one(job) for job in jobs))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'scenario': scenario,
+        'messages': len(jobs),
+        'per_sec': len(jobs) / elapsed if elapsed else float('inf'),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'uploads': sink.messages,
+        'files': sink.files,
+        'mb': sink.bytes / 1024 / 1024,
+        'rss_mb': peak_rss_mb(),
+    }
+
+async def run_all(main, args):
+    # ログインせずにリアクション処理を通すため，ボット自身のユーザーと fetch_user を差し替える
+    main.bot._connection.user = SimpleNamespace(id=BOT_USER_ID)
+
+    async def fetch_user(user_id):
+        return FakeUser(user_id, DeliverySink(0))
+
+    main.bot.fetch_user = fetch_user
+    await main.bot.http_pool.start()
+    try:
+        return await run_scenario(main, args.child_scenario, args, offset=1_000_000)
+    finally:
+        await main.bot.http_pool.close()
+        main.bot.image_cache.close()
+        main.bot.image_transcoder.close()
+
+def run_child(args):
+    """子プロセスとして1つのシナリオを実行し，結果をJSONの1行で出力する"""
+    # main.py の取得先を親プロセスが起動した代替サーバーへ向けてから読み込む
+    os.environ['FXTWITTER_API_BASE'] = f"{args.upstream}/fx"
+    os.environ['PHIXIV_API_BASE'] = f"{args.upstream}/phixiv"
+    os.environ['PIXIV_IMAGE_BASE'] = f"{args.upstream}/pixiv"
+    main = importlib.import_module('main')
+    base_rss = peak_rss_mb()
+    result = asyncio.run(run_all(main, args))
+    result['base_rss_mb'] = base_rss
+    print(RESULT_PREFIX + json.dumps(result))
+
+def run_scenario_process(scenario, upstream):
+    """シナリオを子プロセスで実行して結果を返す (同じ引数に子プロセス用の指定を足して起動する)"""
+    command = [sys.executable, os.path.abspath(__file__), *sys.argv[1:], '--child-scenario', scenario, '--upstream', upstream]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    line = next(line for line in output.splitlines() if line.startswith(RESULT_PREFIX))
+    return json.loads(line[len(RESULT_PREFIX):])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200, help='シナリオごとのメッセージ数')
+    parser.add_argument('--concurrency', type=int, default=20, help='同時に処理するメッセージ数')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--latency-ms', type=float, default=30, help='上流サーバーの応答遅延')
+    parser.add_argument('--upload-latency-ms', type=float, default=50, help='Discordへの送信1回あたりの遅延')
+    parser.add_argument('--image-kb', type=int, default=512, help='ダミー画像のサイズ')
+    parser.add_argument('--images-per-post', type=int, default=4)
+    parser.add_argument('--missing-rate', type=float, default=0.05, help='404を返す画像の割合')
+    # 子プロセスとして1つのシナリオを実行するときに親プロセスが付ける引数
+    parser.add_argument('--child-scenario', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--upstream', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def run():
+    args = parse_args()
+    if args.child_scenario:
+        run_child(args)
+        return
+
+    server = UpstreamServer(args.latency_ms / 1000, args.image_kb * 1024, args.images_per_post, args.missing_rate)
+    server.start()
+    try:
+        results = [run_scenario_process(scenario, server.base_url) for scenario in args.scenarios]
+    finally:
+        server.stop()
+
+    # peakRSS は子プロセス全体の最大，+RSS はそのうち main の読み込み後に増えた分
+    print(
+        f"{'scenario':>10} {'msgs':>6} {'msg/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'uploads':>8} {'files':>6} {'MB':>8} "
+        f"{'peakRSS MB':>11} {'+RSS MB':>8}"
+    )
+    for r in results:
+        print(
+            f"{r['scenario']:>10} {r['messages']:>6} {r['per_sec']:>8.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+            f"{r['uploads']:>8} {r['files']:>6} {r['mb']:>8.1f} {r['rss_mb']:>11.1f} {r['rss_mb'] - r['base_rss_mb']:>8.1f}"
+        )
+    print(f"upstream requests: {server.requests}")
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,103 @@
+"""メトリクス集計のマイクロベンチマーク
+
+Metrics.observe と render の所要時間を測る．計測の前に，既知の観測値から
+出力したヒストグラムが Prometheus の形式どおりか (バケットが累積で単調増加し，
++Inf と _count が観測数に一致するか) を確認する．
+
+    python benchmarks/bench_metrics.py [--observations 100000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+BUCKETS = (0.1, 1, 10)
+# (観測値, 期待するバケットごとの累積件数 (0.1, 1, 10, +Inf))
+CASES = (
+    ([0.05], [1, 1, 1, 1]),
+    ([0.1], [1, 1, 1, 1]),
+    ([0.5, 5], [0, 1, 2, 2]),
+    ([0.01, 0.2, 3, 30], [1, 2, 3, 4]),
+    ([100], [0, 0, 0, 1]),
+    ([], None),
+)
+LINE = re.compile(r'^test_seconds_(bucket|sum|count)(?:\{le="([^"]+)"\})? (\S+)$')
+
+def render_histogram(observations):
+    """observations を記録した Metrics の出力から (バケットの件数のリスト, _sum, _count) を取り出す"""
+    metrics = main.Metrics()
+    metrics.describe('test_seconds', 'histogram', 'Test histogram.', buckets=BUCKETS)
+    for value in observations:
+        metrics.observe('test_seconds', value)
+    buckets, total, count = [], None, None
+    for line in metrics.render().splitlines():
+        match = LINE.match(line)
+        if match is None:
+            continue
+        kind, _, value = match.groups()
+        if kind == 'bucket':
+            buckets.append(int(value))
+        elif kind == 'sum':
+            total = float(value)
+        else:
+            count = int(value)
+    return buckets, total, count
+
+def check_histogram():
+    """ヒストグラムの出力を確認し，問題の説明のリストを返す"""
+    problems = []
+    for observations, expected in CASES:
+        buckets, total, count = render_histogram(observations)
+        if expected is None:
+            if buckets:
+                problems.append(f"{observations}: 観測していないのに出力がある {buckets}")
+            continue
+        if buckets != expected:
+            problems.append(f"{observations}: バケット {buckets} != {expected}")
+        if count != len(observations) or buckets[-1:] != [count]:
+            problems.append(f"{observations}: _count {count} と +Inf {buckets[-1:]} が観測数 {len(observations)} と合わない")
+        if total is None or abs(total - sum(observations)) > 1e-9:
+            problems.append(f"{observations}: _sum {total} != {sum(observations)}")
+
+    # ランダムな観測値でも累積が単調増加し，最後が観測数になる
+    rng = random.Random(0)
+    observations = [rng.expovariate(2) for _ in range(1000)]
+    buckets, _, count = render_histogram(observations)
+    expected = [sum(value <= bound for value in observations) for bound in BUCKETS] + [len(observations)]
+    if buckets != expected or count != len(observations):
+        problems.append(f"ランダムな観測値: バケット {buckets} != {expected}")
+    return problems
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--observations", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    problems = check_histogram()
+    if problems:
+        print(f"ヒストグラムの確認で {len(problems)} 件の問題があります: {problems[:3]}")
+        sys.exit(1)
+
+    rng = random.Random(0)
+    values = [rng.expovariate(10) for _ in range(args.observations)]
+    metrics = main.Metrics()
+    metrics.describe('dis_stage_seconds', 'histogram', 'Latency of each media processing stage.')
+
+    def observe_all():
+        for i, value in enumerate(values):
+            metrics.observe('dis_stage_seconds', value, stage=('resolve', 'download', 'upload')[i % 3])
+
+    best = min(timeit.repeat(observe_all, number=1, repeat=args.repeat))
+    print(f"{'observe':>8}: {best * 1e9 / len(values):8.0f} ns/observation ({len(values)} observations)")
+    best = min(timeit.repeat(metrics.render, number=1, repeat=args.repeat))
+    print(f"{'render':>8}: {best * 1e6:8.0f} µs/render")
+
+if __name__ == "__main__":
+    run()
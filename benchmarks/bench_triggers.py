@@ -0,0 +1,98 @@
+"""on_message のトリガー判定のマイクロベンチマーク
+
+従来の `in` の連鎖と TriggerMatcher による1回の走査を，実際のチャットに近い
+メッセージ群で比較する．判定結果が従来と一致することも確認する．
+
+    python benchmarks/bench_triggers.py [--messages 20000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+CHATTER = (
+    "おはようございます", "今日めっちゃ暑くない？", "それな", "了解です！", "草",
+    "明日のイベント何時からだっけ", "あとで通話できる？", "わかる～", "おつかれさまでした",
+    "新しいアプデ来てるね", "ガチャ爆死した…", "このボス強すぎる", "今から帰ります",
+    "I think the patch notes are out already", "lol same", "brb", "gg",
+    "昨日の配信見た？めちゃくちゃ面白かった", "ノーミスクリアできた！！", "残機あと1つで死んだ",
+)
+LINKS = (
+    "https://x.com/someone/status/1790000000000000000",
+    "https://twitter.com/someone/status/1790000000000000001 これ好き",
+    "見て https://www.pixiv.net/artworks/120000000",
+    "https://www.pixiv.net/en/artworks/120000001",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+)
+TRIGGERS = (
+    main.GACHA_TRIGGER, "今日の機体", "にゃーん", "説明!", "ソースコードどこ？", "スタンプ",
+    main.STICKER[0], "💤",
+)
+
+# キーワード同士が重なっていて，単純な finditer では優先度の高い方を見落とすメッセージ
+OVERLAPPING = (
+    "pixiv.netwitter.com", "pixiv.nex.com", "ソースコードスタンプ", "にゃーんせつめい!",
+    "スタンプixiv.net", "pixiv.net" + main.GACHA_TRIGGER, "そーすたんぷ",
+)
+
+def build_corpus(size, seed=0):
+    """雑談が大半で，リンクやトリガーが少し混ざったメッセージ群を作る"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        roll = rng.random()
+        text = " ".join(rng.choice(CHATTER) for _ in range(rng.randint(1, 4)))
+        if roll < 0.05:
+            text = f"{text} {rng.choice(LINKS)}"
+        elif roll < 0.10:
+            text = f"{text} {rng.choice(TRIGGERS)}"
+        corpus.append(text)
+    return corpus
+
+def legacy_match(content):
+    """変更前の on_message と同じ順序の `in` の連鎖 (メンション判定は除く)"""
+    if "x.com" in content or "twitter.com" in content:
+        return 0
+    if "pixiv.net" in content:
+        return 1
+    if main.GACHA_TRIGGER in content:
+        return 2
+    if any(keyword in content for keyword in ["本日の機体", "今日の機体", "きょうのきたい", "ほんじつのきたい", "イッツルナティックターイム！"]):
+        return 3
+    if any(keyword in content for keyword in ["にゃ～ん", "にゃーん"]):
+        return 4
+    if any(keyword in content for keyword in ["説明!", "せつめい!"]):
+        return 5
+    if any(keyword in content for keyword in ["ソースコード", "そーす"]):
+        return 6
+    if any(keyword in content for keyword in ["スタンプ", "すたんぷ"]):
+        return 7
+    if any(s in content for s in main.STICKER) or "💤" in content:
+        return 8
+    return None
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages)
+    matcher = main.message_trigger_matcher
+
+    mismatches = [text for text in corpus + list(OVERLAPPING) if legacy_match(text) != matcher.match(text)]
+    if mismatches:
+        print(f"判定が従来と異なるメッセージが {len(mismatches)} 件あります: {mismatches[:3]}")
+        sys.exit(1)
+
+    for name, func in (("legacy in-chain", legacy_match), ("TriggerMatcher", matcher.match)):
+        best = min(timeit.repeat(lambda: [func(text) for text in corpus], number=1, repeat=args.repeat))
+        print(f"{name:>16}: {best * 1e9 / len(corpus):8.0f} ns/message ({len(corpus)} messages)")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,72 @@
+"""大きすぎる画像の再エンコード
+
+main.py の ImageTranscoder がプロセスプールの中で transcode_image を実行する．
+プールのプロセスから読み込まれるため，このモジュールは読み込み時に
+Pillow 以外の準備 (Botやセッション，一時ディレクトリの作成など) を行わない．
+spawn の子プロセスは親の起動スクリプトも読み込み直すので，main.py を直接実行すると
+子プロセスでも main.py 全体が読み込まれる．本番では run.py から起動すること．
+"""
+import io
+
+# 画像の縮小に使う (無ければ縮小せずにサイズ超過として扱う)
+try:
+    from PIL import Image, ImageSequence
+except ImportError:
+    Image = ImageSequence = None
+
+TRANSCODE_SCALES = (1.0, 0.85, 0.7, 0.55, 0.4, 0.3, 0.2)
+
+def _encode_still(image, scale, image_format, **options):
+    if scale != 1.0:
+        size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+def _encode_animated_gif(image, scale):
+    size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    frames = [frame.copy().resize(size, Image.LANCZOS) for frame in ImageSequence.Iterator(image)]
+    buffer = io.BytesIO()
+    frames[0].save(
+        buffer, format='GIF', save_all=True, append_images=frames[1:], optimize=True,
+        loop=image.info.get('loop', 0), duration=image.info.get('duration', 100), disposal=2,
+    )
+    return buffer.getvalue()
+
+def transcode_image(source, max_bytes, quality, min_quality, max_pixels):
+    """source (バイト列かファイルパス) を max_bytes 以下に収めて (バイト列, 拡張子) を返す
+
+    アニメーションGIFはGIFのまま縮小し，透過のある画像はPNGのまま縮小する．
+    それ以外はJPEGにして画質を下げ，それでも収まらなければ縮小する．
+    収められなければ None を返す．画素数が max_pixels を超える画像は，
+    展開でメモリを使い果たさないよう読み込む前に ValueError とする．
+    """
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+        if image.width * image.height > max_pixels:
+            raise ValueError(f"image has too many pixels to decode: {image.width}x{image.height}")
+
+        if image.format == 'GIF' and getattr(image, 'is_animated', False):
+            for scale in TRANSCODE_SCALES[1:]:
+                data = _encode_animated_gif(image, scale)
+                if len(data) <= max_bytes:
+                    return data, 'gif'
+            return None
+
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        if has_alpha:
+            image = image.convert('RGBA')
+            for scale in TRANSCODE_SCALES:
+                data = _encode_still(image, scale, 'PNG', optimize=True)
+                if len(data) <= max_bytes:
+                    return data, 'png'
+            return None
+
+        image = image.convert('RGB')
+        qualities = list(range(quality, min_quality - 1, -8)) or [min_quality]
+        for scale in TRANSCODE_SCALES:
+            for jpeg_quality in (qualities if scale == 1.0 else qualities[-1:]):
+                data = _encode_still(image, scale, 'JPEG', quality=jpeg_quality, optimize=True, progressive=True)
+                if len(data) <= max_bytes:
+                    return data, 'jpg'
+        return None
@@ -9,18 +9,42 @@ import io
 import json
 import aiohttp
 import traceback
+import concurrent.futures
+import itertools
+import hashlib
+import sqlite3
+import threading
+import math
+import shutil
+import tempfile
+import time
+from collections import OrderedDict, deque
+import contextlib
+import atexit
+import bisect
+import signal
+import multiprocessing
+import sys
+from urllib.parse import urlsplit
+
+# 画像の縮小 (Pillowが無ければ Image は None になり，縮小せずにサイズ超過として扱う)
+from image_transcode import Image, transcode_image
 
 # Webサーバーを非同期実行するためのライブラリ
 from hypercorn.config import Config
 from hypercorn.asyncio import serve
 
 # -----------------------------------------------------------------------------
-# 状態の永続化 (JSONファイル管理)
+# 状態の永続化 (SQLite)
 # -----------------------------------------------------------------------------
-SETTINGS_FILE = 'user_settings.json'
+SETTINGS_FILE = 'user_settings.json'  # 旧形式．DBが空のときだけ読み込んで移行する
+SETTINGS_DB_FILE = os.environ.get("SETTINGS_DB_FILE", 'user_settings.db')
+# 設定変更をまとめて書き込むまでの待ち時間 (秒)
+SETTINGS_FLUSH_DELAY = float(os.environ.get("SETTINGS_FLUSH_DELAY", 2.0))
+DELIVERY_SETTING = 'delivery'  # 画像の送信先 ('channel' または 'dm')
 
 def load_user_settings():
-    """起動時に設定ファイルを読み込む関数"""
+    """旧形式の設定ファイルを読み込む関数"""
     try:
         with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
             return json.load(f)
@@ -28,10 +52,1257 @@ def load_user_settings():
         # ファイルが存在しないか中身が空の場合は空の辞書を返す
         return {}
 
-def save_user_settings(settings):
-    """設定変更時にファイルに書き出す関数"""
-    with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(settings, f, indent=4)
+class UserSettingsStore:
+    """ユーザーごとの設定をSQLite (WALモード) に保存するストア
+
+    値はメモリ上に持ち，変更は SETTINGS_FLUSH_DELAY 秒ごとにまとめて
+    イベントループ外で1トランザクションとして書き込む．変更された行だけを
+    書くので，ユーザーや設定項目が増えても全体を書き直すことはない．
+    送信先設定は従来の辞書と同じく `get(user_id, 'channel')` や
+    `store[user_id] = 'dm'` で，それ以外は get_setting/set_setting で扱う．
+    """
+
+    def __init__(self, path, flush_delay=SETTINGS_FLUSH_DELAY):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._values = {}  # (user_id, key) -> 値
+        self._dirty = {}  # (user_id, key) -> 値 (Noneは削除)
+        self._conn = None
+        self._lock = asyncio.Lock()
+        self._flush_task = None
+        self.loaded = False
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS user_settings ('
+                ' user_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,'
+                ' PRIMARY KEY (user_id, key))'
+            )
+            self._conn = conn
+        return self._conn
+
+    def _read_rows(self):
+        conn = self._connect()
+        rows = conn.execute('SELECT user_id, key, value FROM user_settings').fetchall()
+        if not rows:
+            legacy = load_user_settings()
+            if legacy:
+                rows = [(user_id, DELIVERY_SETTING, json.dumps(value)) for user_id, value in legacy.items()]
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO user_settings VALUES (?, ?, ?)', rows)
+                print(f"Migrated {len(rows)} user settings from {SETTINGS_FILE}.")
+        return rows
+
+    def _write_rows(self, changes):
+        conn = self._connect()
+        upserts = [(user_id, key, json.dumps(value)) for (user_id, key), value in changes.items() if value is not None]
+        deletes = [(user_id, key) for (user_id, key), value in changes.items() if value is None]
+        with conn:  # 全ての変更を1つのトランザクションで書き込む
+            conn.executemany('INSERT OR REPLACE INTO user_settings VALUES (?, ?, ?)', upserts)
+            conn.executemany('DELETE FROM user_settings WHERE user_id = ? AND key = ?', deletes)
+
+    async def load(self):
+        """起動時にイベントループ外で全設定を読み込む"""
+        rows = await asyncio.to_thread(self._read_rows)
+        for user_id, key, value in rows:
+            # 読み込み完了前に変更された値は上書きしない
+            self._values.setdefault((user_id, key), json.loads(value))
+        self.loaded = True
+
+    def get_setting(self, user_id, key, default=None):
+        return self._values.get((str(user_id), key), default)
+
+    def set_setting(self, user_id, key, value):
+        """設定を変更し，書き込みを予約する．None を渡すと削除する"""
+        item = (str(user_id), key)
+        if value is None:
+            self._values.pop(item, None)
+        else:
+            self._values[item] = value
+        self._dirty[item] = value
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await asyncio.shield(self.flush())
+
+    async def flush(self):
+        """予約されている変更を書き込む"""
+        async with self._lock:
+            if not self._dirty:
+                return
+            changes, self._dirty = self._dirty, {}
+            try:
+                await asyncio.to_thread(self._write_rows, changes)
+            except Exception:
+                # 書き込めなかった変更は次回に回す (その間に更新されたものはそちらを優先)
+                for item, value in changes.items():
+                    self._dirty.setdefault(item, value)
+                raise
+
+    async def close(self):
+        """終了時に残りの変更を書き込んでDBを閉じる"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+    # --- 送信先設定を従来の辞書と同じように扱うためのメソッド ---
+    def get(self, user_id, default=None):
+        return self.get_setting(user_id, DELIVERY_SETTING, default)
+
+    def __getitem__(self, user_id):
+        value = self.get(user_id)
+        if value is None:
+            raise KeyError(user_id)
+        return value
+
+    def __setitem__(self, user_id, value):
+        self.set_setting(user_id, DELIVERY_SETTING, value)
+
+    def __contains__(self, user_id):
+        return (str(user_id), DELIVERY_SETTING) in self._values
+
+# -----------------------------------------------------------------------------
+# HTTPクライアント (プロセス共通のコネクションプール)
+# -----------------------------------------------------------------------------
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36'
+
+# 接続先ごとのヘッダー．pixivの画像サーバーはRefererが無いと403を返す
+HTTP_HEADER_PROFILES = {
+    'default': {'User-Agent': USER_AGENT},
+    'twitter': {'User-Agent': USER_AGENT},
+    'pixiv': {'User-Agent': USER_AGENT, 'Referer': 'https://www.pixiv.net/'},
+}
+PIXIV_IMAGE_HOSTS = ('pixiv.re', 'pximg.net', 'phixiv.net')
+
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", 10))
+HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", 300))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_TOTAL_TIMEOUT = float(os.environ.get("HTTP_TOTAL_TIMEOUT", 60))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+
+def header_profile_for_url(url):
+    """URLのホスト名から使うヘッダープロファイル名を決める"""
+    host = (urlsplit(url).hostname or '').lower()
+    if any(host == h or host.endswith('.' + h) for h in PIXIV_IMAGE_HOSTS):
+        return 'pixiv'
+    if host.endswith('fxtwitter.com') or host.endswith('twimg.com'):
+        return 'twitter'
+    return 'default'
+
+class HttpPool:
+    """aiohttp.ClientSessionを1つだけ持ち，全リクエストで接続を使い回すクラス
+
+    TCP/TLSの接続とDNSの解決結果をリクエスト間で共有するため，
+    リンクごとにハンドシェイクをやり直さずに済む．
+    """
+
+    def __init__(self, limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                 dns_cache_ttl=HTTP_DNS_CACHE_TTL, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                 total_timeout=HTTP_TOTAL_TIMEOUT, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+        self._session = None
+
+    def _open(self):
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def start(self):
+        """セッションを作成する．setup_hookから一度だけ呼ばれる想定"""
+        self._open()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @property
+    def session(self):
+        # setup_hookを経由しない実行 (ベンチマーク等) でも使えるよう遅延作成する
+        self._open()
+        return self._session
+
+    def get(self, url, profile=None, headers=None, **kwargs):
+        """プロファイルのヘッダーを付けてGETする．`async with`でそのまま使える"""
+        request_headers = dict(HTTP_HEADER_PROFILES[profile or header_profile_for_url(url)])
+        if headers:
+            request_headers.update(headers)
+        return self.session.get(url, headers=request_headers, **kwargs)
+
+    def head(self, url, profile=None, headers=None, **kwargs):
+        """get() と同じくプロファイルのヘッダーを付けてHEADする"""
+        request_headers = dict(HTTP_HEADER_PROFILES[profile or header_profile_for_url(url)])
+        if headers:
+            request_headers.update(headers)
+        return self.session.head(url, headers=request_headers, **kwargs)
+
+# -----------------------------------------------------------------------------
+# キャッシュ
+# -----------------------------------------------------------------------------
+RESOLVE_CACHE_SIZE = int(os.environ.get("RESOLVE_CACHE_SIZE", 1024))
+RESOLVE_CACHE_TTL = float(os.environ.get("RESOLVE_CACHE_TTL", 600))
+RESOLVE_CACHE_NEGATIVE_TTL = float(os.environ.get("RESOLVE_CACHE_NEGATIVE_TTL", 60))
+# リアクション保存の判定用 (メッセージ本体/リンクの有無/保存済みの組)
+REACTION_MESSAGE_CACHE_SIZE = int(os.environ.get("REACTION_MESSAGE_CACHE_SIZE", 512))
+REACTION_MESSAGE_CACHE_TTL = float(os.environ.get("REACTION_MESSAGE_CACHE_TTL", 300))
+LINK_MESSAGE_INDEX_SIZE = int(os.environ.get("LINK_MESSAGE_INDEX_SIZE", 50000))
+LINK_MESSAGE_INDEX_TTL = float(os.environ.get("LINK_MESSAGE_INDEX_TTL", 24 * 60 * 60))
+REACTION_SAVE_DEDUP_WINDOW = float(os.environ.get("REACTION_SAVE_DEDUP_WINDOW", 300))
+
+class AsyncTTLCache:
+    """TTLとLRU上限を持つ非同期キャッシュ
+
+    同じキーへの同時要求は1回の読み込みにまとめる (single-flight)．
+    空の結果や例外も negative_ttl の間だけ覚えておき，失敗し続ける
+    リンクで上流を叩き続けないようにする．
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # key -> (有効期限, 値, 例外)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _store(self, key, value, error, ttl):
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value, error)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_load(self, key, loader):
+        """キャッシュにあれば返し，無ければ loader() を1回だけ実行して結果を共有する"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value, error = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if error is not None:
+                    raise error
+                return value
+            del self._entries[key]
+
+        future = self._inflight.get(key)
+        while future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 読み込みを担当していた呼び出し元が取り消されただけなら，こちらで読み込み直す
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+            future = self._inflight.get(key)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except Exception as e:
+            self._store(key, None, e, self.negative_ttl)
+            future.set_exception(e)
+            future.exception()  # 待機者がいなくても警告を出さない
+            raise
+        else:
+            self._store(key, value, None, self.ttl if value else self.negative_ttl)
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+            if not future.done():
+                future.cancel()
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+        }
+
+class ExpiringDict:
+    """TTLとLRU上限を持つ小さな辞書 (読み込み処理を伴わない同期版)"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (有効期限, 値)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __setitem__(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+MAX_FILE_SIZE = 24 * 1024 * 1024  # 1ファイルあたりの送信できるサイズの上限
+IMAGE_CACHE_MEMORY_BYTES = int(os.environ.get("IMAGE_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "")
+IMAGE_CACHE_DISK_BYTES = int(os.environ.get("IMAGE_CACHE_DISK_BYTES", 512 * 1024 * 1024))
+# これより大きいダウンロードはメモリに載せず，ディスクへ直接書き出す
+IMAGE_SPOOL_BYTES = int(os.environ.get("IMAGE_SPOOL_BYTES", 2 * 1024 * 1024))
+
+class SpoolWriter:
+    """ダウンロード中の画像を受け取るバッファ
+
+    max_memory_bytes まではメモリに溜め，超えた時点で make_path() が返すパスの
+    .tmp に書き出して以降はファイルへ追記する．書き込みはイベントループ外で行う．
+    """
+
+    def __init__(self, make_path, max_memory_bytes):
+        self._make_path = make_path
+        self.path = None
+        self.max_memory_bytes = max_memory_bytes
+        self.size = 0
+        self._chunks = []
+        self._file = None
+
+    @property
+    def on_disk(self):
+        return self._file is not None
+
+    def _open_and_write(self, chunks):
+        self._file = open(self.path + '.tmp', 'wb')
+        self._file.writelines(chunks)
+
+    async def write(self, chunk):
+        self.size += len(chunk)
+        if self._file is None and self.size <= self.max_memory_bytes:
+            self._chunks.append(chunk)
+            return
+        if self._file is None:
+            chunks, self._chunks = self._chunks + [chunk], []
+            self.path = self._make_path()
+            await asyncio.to_thread(self._open_and_write, chunks)
+        else:
+            await asyncio.to_thread(self._file.write, chunk)
+
+    def getvalue(self):
+        return b''.join(self._chunks)
+
+    def _commit_file(self):
+        self._file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    async def commit(self):
+        """ディスクに書き出した内容を確定させる"""
+        await asyncio.to_thread(self._commit_file)
+
+    def _discard_file(self):
+        self._file.close()
+        try:
+            os.remove(self.path + '.tmp')
+        except FileNotFoundError:
+            pass
+
+    async def discard(self):
+        self._chunks = []
+        if self._file is not None:
+            await asyncio.to_thread(self._discard_file)
+
+class ImageCache:
+    """ダウンロード済み画像をURLごとに保持するキャッシュ
+
+    小さい画像はバイト列としてメモリに，大きい画像やメモリから追い出された画像は
+    spill_dir 上のファイルとして保持し，それぞれ合計サイズの上限を超えたら
+    古いものから捨てる．spill_dir を指定しない場合は，初めてディスクを使うときに
+    一時ディレクトリを作り，close() か終了時に削除する．
+    fetch() はバイト列かファイルパスを返し，送信先ごとにそこから
+    discord.File を作るため，1回のダウンロードで全ての送信先をまかなえる．
+    """
+
+    def __init__(self, max_memory_bytes, spill_dir=None, max_disk_bytes=0, spool_bytes=IMAGE_SPOOL_BYTES):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.spool_bytes = spool_bytes
+        self._owns_spill_dir = not spill_dir
+        self.spill_dir = spill_dir or None
+        self._memory = OrderedDict()  # url -> bytes
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # sha256(url) -> サイズ
+        self._disk_bytes = 0
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if self.spill_dir:
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        """前回までに退避したファイルを古い順に索引へ登録する"""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def close(self):
+        """一時ディレクトリを使っていた場合は削除する"""
+        if self._owns_spill_dir and self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self._disk.clear()
+            self._disk_bytes = 0
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        if self.spill_dir is None:
+            # 退避先を指定されていなければ，必要になった時点で一時ディレクトリを作る
+            self.spill_dir = tempfile.mkdtemp(prefix='dis_test_images_')
+            atexit.register(self.close)
+        return os.path.join(self.spill_dir, key)
+
+    @staticmethod
+    def _write_file(path, data):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    async def _register_disk(self, key, size):
+        self._disk[key] = size
+        self._disk_bytes += size
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            old_key, old_size = self._disk.popitem(last=False)
+            self._disk_bytes -= old_size
+            await asyncio.to_thread(self._remove_file, old_key)
+
+    async def _spill(self, url, data):
+        if len(data) > self.max_disk_bytes:
+            return
+        key = self._key(url)
+        if key in self._disk:
+            self._disk.move_to_end(key)
+            return
+        try:
+            await asyncio.to_thread(self._write_file, self._path(key), data)
+        except OSError as e:
+            print(f"Failed to spill image cache entry to disk: {e}")
+            return
+        await self._register_disk(key, len(data))
+
+    async def put(self, url, data):
+        if len(data) > self.max_memory_bytes:
+            await self._spill(url, data)
+            return
+        old_data = self._memory.pop(url, None)
+        if old_data is not None:
+            self._memory_bytes -= len(old_data)
+        self._memory[url] = data
+        self._memory_bytes += len(data)
+        evicted = []
+        while self._memory_bytes > self.max_memory_bytes:
+            old_url, old_data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old_data)
+            evicted.append((old_url, old_data))
+        for old_url, old_data in evicted:
+            await self._spill(old_url, old_data)
+
+    def _lookup(self, url):
+        data = self._memory.get(url)
+        if data is not None:
+            self._memory.move_to_end(url)
+            return data
+        key = self._key(url)
+        if key in self._disk and os.path.exists(self._path(key)):
+            self._disk.move_to_end(key)
+            return self._path(key)
+        return None
+
+    async def _download(self, url, downloader):
+        key = self._key(url)
+        writer = SpoolWriter(lambda: self._path(key), self.spool_bytes)
+        try:
+            found = await downloader(writer)
+        except BaseException:
+            await writer.discard()
+            raise
+        if not found:
+            await writer.discard()
+            return None
+        if not writer.on_disk:
+            data = writer.getvalue()
+            await self.put(url, data)
+            return data
+        await writer.commit()
+        if key in self._disk:
+            self._disk_bytes -= self._disk.pop(key)
+        await self._register_disk(key, writer.size)
+        return self._path(key)
+
+    async def fetch(self, url, downloader):
+        """キャッシュに無ければ downloader(writer) で取得して保存する．同じURLの同時取得は1回にまとめる
+
+        downloader は受け取った SpoolWriter に本文を書き込み，画像が見つかったかを返す．
+        戻り値はメモリ上のバイト列かキャッシュファイルのパスで，見つからなかった場合は None．
+        """
+        blob = self._lookup(url)
+        if blob is not None:
+            self.hits += 1
+            return blob
+
+        future = self._inflight.get(url)
+        while future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 取得を担当していた呼び出し元が取り消されただけなら，こちらで取得し直す
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+            future = self._inflight.get(url)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[url] = future
+        try:
+            blob = await self._download(url, downloader)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # 待機者がいなくても警告を出さない
+            raise
+        else:
+            future.set_result(blob)
+            return blob
+        finally:
+            self._inflight.pop(url, None)
+            if not future.done():
+                future.cancel()
+
+    def stats(self):
+        return {
+            'memory_items': len(self._memory),
+            'memory_bytes': self._memory_bytes,
+            'disk_items': len(self._disk),
+            'disk_bytes': self._disk_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+def image_file(blob, filename):
+    """ImageCache.fetch() の結果から送信用の discord.File を作る (バイト列はコピーしない)"""
+    if isinstance(blob, bytes):
+        return discord.File(io.BytesIO(blob), filename=filename)
+    return discord.File(blob, filename=filename)
+
+# -----------------------------------------------------------------------------
+# pixiv原寸画像の拡張子解決
+# -----------------------------------------------------------------------------
+PIXIV_EXTENSIONS = ('png', 'jpg', 'gif')
+PIXIV_EXTENSION_MEMORY_SIZE = int(os.environ.get("PIXIV_EXTENSION_MEMORY_SIZE", 4096))
+PIXIV_ORIGINAL_PATTERN = re.compile(r'/img-original/img/\d{4}/\d{2}/\d{2}/\d{2}/\d{2}/\d{2}/(\d+)_p\d+\.(png|jpg|gif)(?:$|\?)')
+
+class PixivExtensionResolver:
+    """pixivの原寸画像の拡張子を推測するクラス
+
+    同じ作品のページは拡張子が揃っていることが多いため，判明した拡張子を
+    作品IDごとに覚えておく．分からない場合はメタデータから推測し，
+    それでも駄目なら全候補にHEADを並行して投げて最初に見つかったものを採用する．
+    """
+
+    def __init__(self, http_pool, maxsize=PIXIV_EXTENSION_MEMORY_SIZE):
+        self.http_pool = http_pool
+        self.maxsize = maxsize
+        self._known = OrderedDict()  # illust_id -> 拡張子
+
+    def remember(self, illust_id, extension):
+        self._known[illust_id] = extension
+        self._known.move_to_end(illust_id)
+        while len(self._known) > self.maxsize:
+            self._known.popitem(last=False)
+
+    def observe(self, img_url):
+        """ダウンロードに成功したURLが原寸画像なら，その拡張子を覚える"""
+        url_match = PIXIV_ORIGINAL_PATTERN.search(img_url)
+        if url_match:
+            self.remember(*url_match.groups())
+
+    def infer(self, illust_id, metadata):
+        """記憶かphixivのメタデータから拡張子を推測する．分からなければNone"""
+        extension = self._known.get(illust_id)
+        if extension is not None:
+            self._known.move_to_end(illust_id)
+            return extension
+        # image_proxy_urls 等に原寸画像のURLが含まれていればその拡張子を使う
+        # (img-master 等の縮小画像は常にjpgなので参考にしない)
+        values = metadata.values() if isinstance(metadata, dict) else ()
+        for value in values:
+            for candidate in (value if isinstance(value, list) else [value]):
+                if not isinstance(candidate, str):
+                    continue
+                url_match = PIXIV_ORIGINAL_PATTERN.search(candidate)
+                if url_match and url_match.group(1) == illust_id:
+                    return url_match.group(2)
+        return None
+
+    async def _probe_one(self, base_url, extension):
+        async with self.http_pool.head(f"{base_url}.{extension}", profile='pixiv', allow_redirects=True) as resp:
+            return extension if resp.status == 200 else None
+
+    async def probe(self, base_url):
+        """全ての拡張子にHEADを並行して投げ，最初に200を返したものを返す"""
+        tasks = [asyncio.create_task(self._probe_one(base_url, ext)) for ext in PIXIV_EXTENSIONS]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    extension = await next_done
+                except Exception as e:
+                    print(f"Extension probe failed for {base_url}: {e}")
+                    continue
+                if extension is not None:
+                    return extension
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+            # 失敗済みで結果を取り出していないタスクの例外が「never retrieved」と出ないよう回収する
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def resolve(self, illust_id, base_url, metadata):
+        extension = self.infer(illust_id, metadata)
+        if extension is None:
+            extension = await self.probe(base_url)
+            if extension is not None:
+                self.remember(illust_id, extension)
+        return extension
+
+    def reorder(self, url_group):
+        """原寸画像のURL候補を，覚えている拡張子のURLが先頭になるよう並べ直したリストを返す
+
+        拡張子が分からないまま作った候補は解決結果のキャッシュに残るため，読み出すたびに並べ直す．
+        原寸画像の候補でないか，拡張子を覚えていなければそのまま返す．
+        """
+        url_match = PIXIV_ORIGINAL_PATTERN.search(url_group[0]) if len(url_group) > 1 else None
+        extension = self._known.get(url_match.group(1)) if url_match else None
+        if extension is None:
+            return url_group
+        suffix = f".{extension}"
+        return sorted(url_group, key=lambda url: not url.split('?')[0].endswith(suffix))
+
+    @staticmethod
+    def candidates(base_url, extension=None):
+        """推測した拡張子を先頭にしたURL候補のリストを返す"""
+        ordered = list(PIXIV_EXTENSIONS)
+        if extension in ordered:
+            ordered.remove(extension)
+            ordered.insert(0, extension)
+        return [f"{base_url}.{ext}" for ext in ordered]
+
+# -----------------------------------------------------------------------------
+# メディア処理のジョブキュー
+# -----------------------------------------------------------------------------
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 4))
+MEDIA_QUEUE_SIZE = int(os.environ.get("MEDIA_QUEUE_SIZE", 100))
+MEDIA_QUEUE_PER_USER = int(os.environ.get("MEDIA_QUEUE_PER_USER", 5))
+MEDIA_DRAIN_TIMEOUT = float(os.environ.get("MEDIA_DRAIN_TIMEOUT", 30))
+
+class MediaJobQueue:
+    """リンク処理を一定数のワーカーで順番に実行するキュー
+
+    ジョブはサーバー→ユーザーの順にラウンドロビンで取り出すため，1人が
+    大量にリンクを貼っても他のユーザーの処理が後回しになり続けることはない．
+    同じキーのジョブが待機中/実行中なら受け付けず，キュー全体かユーザーごとの
+    上限を超えた場合も受け付けない (呼び出し側で利用者に知らせる)．
+    """
+
+    QUEUED = 'queued'
+    DUPLICATE = 'duplicate'
+    BUSY = 'busy'
+
+    def __init__(self, workers=MEDIA_WORKERS, max_size=MEDIA_QUEUE_SIZE, max_per_user=MEDIA_QUEUE_PER_USER):
+        self.workers = workers
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        self._guilds = OrderedDict()  # guild_id -> OrderedDict(user_id -> deque[(key, job_factory, enqueued_at)])
+        self._pending_per_user = {}
+        self._active_keys = set()  # 待機中と実行中のジョブのキー
+        self._available = asyncio.Semaphore(0)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._worker_tasks = []
+        self._accepting = True
+        self.depth = 0
+        self.running = 0
+        self.started = 0
+        self.completed = 0
+        self.rejected = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+
+    def start(self):
+        if self._worker_tasks:
+            return
+        self._accepting = True
+        self._worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    def submit(self, guild_id, user_id, key, job_factory):
+        """ジョブを登録し，QUEUED/DUPLICATE/BUSY のいずれかを返す"""
+        if key in self._active_keys:
+            return self.DUPLICATE
+        if (not self._accepting or self.depth >= self.max_size
+                or self._pending_per_user.get(user_id, 0) >= self.max_per_user):
+            self.rejected += 1
+            return self.BUSY
+
+        users = self._guilds.setdefault(guild_id, OrderedDict())
+        users.setdefault(user_id, deque()).append((key, job_factory, time.monotonic()))
+        self._pending_per_user[user_id] = self._pending_per_user.get(user_id, 0) + 1
+        self._active_keys.add(key)
+        self.depth += 1
+        self._idle.clear()
+        self._available.release()
+        return self.QUEUED
+
+    def _next_job(self):
+        # 先頭のサーバーの先頭のユーザーから1件取り出し，どちらも末尾に回す
+        guild_id, users = next(iter(self._guilds.items()))
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        del users[user_id]
+        if jobs:
+            users[user_id] = jobs
+        del self._guilds[guild_id]
+        if users:
+            self._guilds[guild_id] = users
+
+        remaining = self._pending_per_user[user_id] - 1
+        if remaining:
+            self._pending_per_user[user_id] = remaining
+        else:
+            del self._pending_per_user[user_id]
+        self.depth -= 1
+        return job
+
+    async def _worker(self, worker_id):
+        while True:
+            await self._available.acquire()
+            if not self._guilds:
+                return  # close() による停止の合図
+            key, job_factory, enqueued_at = self._next_job()
+            wait = time.monotonic() - enqueued_at
+            self.last_wait = wait
+            self.max_wait = max(self.max_wait, wait)
+            self.total_wait += wait
+            self.started += 1
+            self.running += 1
+            try:
+                await job_factory()
+            except asyncio.CancelledError:
+                # close() による停止なら止まり，ジョブの中から漏れてきただけなら次のジョブへ進む
+                if asyncio.current_task().cancelling():
+                    raise
+                print(f"Media job {key} was cancelled.")
+            except Exception as e:
+                print(f"Media job {key} failed: {e}")
+                traceback.print_exc()
+            finally:
+                self.running -= 1
+                self.completed += 1
+                self._active_keys.discard(key)
+                if self.depth == 0 and self.running == 0:
+                    self._idle.set()
+
+    async def close(self, timeout=MEDIA_DRAIN_TIMEOUT):
+        """新規受付を止め，待機中のジョブが終わるまで (最大 timeout 秒) 待ってから停止する"""
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Media queue did not drain in {timeout}s ({self.depth} queued, {self.running} running).")
+        for _ in self._worker_tasks:
+            self._available.release()
+        for task in self._worker_tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'running': self.running,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'last_wait': self.last_wait,
+            'max_wait': self.max_wait,
+            'avg_wait': self.total_wait / self.started if self.started else 0.0,
+            'guilds': {guild_id: sum(len(jobs) for jobs in users.values()) for guild_id, users in self._guilds.items()},
+        }
+
+# -----------------------------------------------------------------------------
+# プロセス分割 (Gatewayプロセス → メディアワーカープロセス)
+# -----------------------------------------------------------------------------
+# 実行モード: single (1プロセスで全て処理) / gateway (Gatewayとジョブの振り分け) / worker (メディア処理のみ)
+RUN_MODES = ('single', 'gateway', 'worker')
+RUN_MODE = os.environ.get("RUN_MODE", "single")
+# gateway モードで起動するワーカープロセスの数 (0なら worker モードで別に起動したものを使う)
+MEDIA_WORKER_PROCESSES = int(os.environ.get("MEDIA_WORKER_PROCESSES", 2))
+# Gatewayプロセスとワーカーがジョブをやり取りするUnixソケット．既定では実行ユーザー専用のディレクトリに置き，
+# シャードIDごとに分けてシャードを分担する複数のGatewayプロセスが同じホストで動いても取り合わないようにする．
+# 指定する場合は，他のユーザーが書き込めないディレクトリのパスにすること
+MEDIA_IPC_DIR = os.path.join(tempfile.gettempdir(), f"dis_test-{os.getuid()}")
+MEDIA_IPC_SOCKET = os.environ.get("MEDIA_IPC_SOCKET") or os.path.join(
+    MEDIA_IPC_DIR, f"media-{os.environ.get('DISCORD_SHARD_IDS', '').replace(',', '-') or 'all'}.sock",
+)
+# ワーカーが接続直後に送る名乗り．名乗らない接続 (別のGatewayプロセスの生存確認など) にはジョブを送らない
+MEDIA_WORKER_HELLO = 'media-worker'
+MEDIA_IPC_LINE_LIMIT = 1024 * 1024  # ジョブ1件 (JSON1行) の最大長
+# ワーカーがGatewayプロセスへの接続を試み続ける時間 (秒)
+MEDIA_WORKER_CONNECT_TIMEOUT = float(os.environ.get("MEDIA_WORKER_CONNECT_TIMEOUT", 30.0))
+# ワーカーからの結果を待つ最大時間 (秒)．応答しないワーカーにキューの枠を取られ続けないようにする
+MEDIA_WORKER_JOB_TIMEOUT = float(os.environ.get("MEDIA_WORKER_JOB_TIMEOUT", 300.0))
+# 止まったワーカープロセスを起動し直すまでの確認間隔 (秒)
+MEDIA_WORKER_RESTART_INTERVAL = float(os.environ.get("MEDIA_WORKER_RESTART_INTERVAL", 5.0))
+
+def prepare_private_dir(path):
+    """実行ユーザーだけが使えるディレクトリを用意する．他のユーザーのものや権限が緩いものは使わない"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if os.path.islink(path) or not os.path.isdir(path) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"{path} は他のユーザーも使えるため，ワーカー用のソケットを置けません．")
+
+class MediaWorkerPool:
+    """Gatewayプロセスから，メディア処理をワーカープロセスへ振り分けるプール
+
+    ワーカーはUnixソケットへ接続して名乗り，1行1件のJSONでジョブを受け取って，
+    処理が終わると同じIDで結果を返す．ジョブは処理中の件数が最も少ない
+    ワーカーへ送り，接続中のワーカーが居なければこのプロセスで処理する．
+    processes を指定すると，その数のワーカープロセスを起動して見張る．
+    """
+
+    def __init__(self, socket_path=MEDIA_IPC_SOCKET, processes=MEDIA_WORKER_PROCESSES):
+        self.socket_path = socket_path
+        self.processes = processes
+        self._server = None
+        self._supervisor = None
+        self._process_list = [None] * processes
+        self._workers = {}  # StreamWriter -> {ジョブID: 結果を待つFuture}
+        self._job_ids = itertools.count()
+        self.dispatched = 0
+        self.failed = 0
+        self.local = 0
+
+    async def start(self):
+        if os.path.dirname(self.socket_path) == MEDIA_IPC_DIR:
+            prepare_private_dir(MEDIA_IPC_DIR)
+        await self._remove_stale_socket()
+        self._server = await asyncio.start_unix_server(
+            self._serve_worker, self.socket_path, limit=MEDIA_IPC_LINE_LIMIT
+        )
+        # ジョブにはメッセージの内容が含まれるため，他のユーザーからは接続できないようにする
+        os.chmod(self.socket_path, 0o600)
+        if self.processes:
+            self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _remove_stale_socket(self):
+        """前回の異常終了で残ったソケットを消す．別のGatewayプロセスが使用中ならエラーにする"""
+        try:
+            _, writer = await asyncio.open_unix_connection(self.socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+            return
+        writer.close()
+        raise RuntimeError(
+            f"{self.socket_path} は別のGatewayプロセスが使用中です．MEDIA_IPC_SOCKET で別のパスを指定してください．"
+        )
+
+    async def _supervise(self):
+        """ワーカープロセスを起動し，止まったものは起動し直す"""
+        # 動作中のイベントループやスレッドを引き継がないよう fork ではなく spawn で起動する
+        context = multiprocessing.get_context('spawn')
+        while True:
+            for index, process in enumerate(self._process_list):
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    print(f"Media worker {index} exited with code {process.exitcode}. Restarting.")
+                # 縮小用のプロセスプールを持てるよう daemon にはせず，close() で終了を待つ
+                process = context.Process(
+                    target=media_worker_process_main, args=(index, self.socket_path), name=f"media-worker-{index}"
+                )
+                process.start()
+                self._process_list[index] = process
+            await asyncio.sleep(MEDIA_WORKER_RESTART_INTERVAL)
+
+    async def _serve_worker(self, reader, writer):
+        """接続してきたワーカー1つ分の結果を受け取り続ける"""
+        try:
+            hello = json.loads(await asyncio.wait_for(reader.readline(), MEDIA_WORKER_CONNECT_TIMEOUT) or b'null')
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            hello = None
+        if not isinstance(hello, dict) or hello.get('hello') != MEDIA_WORKER_HELLO:
+            writer.close()
+            return
+        pending = self._workers[writer] = {}
+        print(f"--- ⚙️ Media worker connected ({len(self._workers)} connected) ---")
+        try:
+            while line := await reader.readline():
+                reply = json.loads(line)
+                future = pending.pop(reply['id'], None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (ConnectionError, ValueError) as e:
+            print(f"Media worker connection failed: {e}")
+        finally:
+            del self._workers[writer]
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("media worker disconnected"))
+            writer.close()
+            print(f"Media worker disconnected ({len(self._workers)} connected).")
+
+    async def run(self, job, local_job_factory):
+        """ジョブをワーカーで実行して終わるまで待つ．ワーカーが居なければ local_job_factory を実行する"""
+        if not self._workers:
+            self.local += 1
+            return await local_job_factory()
+
+        writer, pending = min(self._workers.items(), key=lambda item: len(item[1]))
+        job_id = next(self._job_ids)
+        future = asyncio.get_running_loop().create_future()
+        pending[job_id] = future
+        self.dispatched += 1
+        try:
+            writer.write(json.dumps({'id': job_id, **job}).encode('utf-8') + b'\n')
+            await writer.drain()
+            reply = await asyncio.wait_for(future, MEDIA_WORKER_JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            # 後から届いた結果は捨てる．ワーカー側の処理は続いている可能性があるので，ここでもやり直さない
+            self.failed += 1
+            print(f"Media job {job['kind']} timed out in worker after {MEDIA_WORKER_JOB_TIMEOUT}s.")
+            return
+        except ConnectionError:
+            # 途中まで送信済みの可能性があるので，二重に送らないようこのプロセスでは処理し直さない
+            self.failed += 1
+            raise
+        finally:
+            pending.pop(job_id, None)
+        if not reply['ok']:
+            self.failed += 1
+            print(f"Media job {job['kind']} failed in worker: {reply['error']}")
+
+    async def close(self, timeout=MEDIA_DRAIN_TIMEOUT):
+        """ソケットを閉じ，ワーカープロセスの終了を (最大 timeout 秒) 待つ"""
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._supervisor
+        if self._server is not None:
+            self._server.close()
+        # 接続が切れるとワーカーは処理中のジョブを終えてから終了する
+        for writer in list(self._workers):
+            writer.close()
+        await asyncio.to_thread(self._join_processes, timeout)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+
+    def _join_processes(self, timeout):
+        for process in self._process_list:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                print(f"Media worker {process.name} did not exit in {timeout}s. Terminating.")
+                process.terminate()
+                process.join()
+
+    def stats(self):
+        return {
+            'connected': len(self._workers),
+            'processes': sum(1 for process in self._process_list if process is not None and process.is_alive()),
+            'inflight': sum(len(pending) for pending in self._workers.values()),
+            'dispatched': self.dispatched,
+            'failed': self.failed,
+            'local': self.local,
+        }
+
+# -----------------------------------------------------------------------------
+# 計測 (Prometheusテキスト形式で /metrics から公開する)
+# -----------------------------------------------------------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+EVENT_LOOP_LAG_INTERVAL = float(os.environ.get("EVENT_LOOP_LAG_INTERVAL", 1.0))
+# 最後の遅延計測からこれ以上経っていれば，イベントループが止まっているとみなす
+EVENT_LOOP_STALL_SECONDS = float(os.environ.get("EVENT_LOOP_STALL_SECONDS", 10.0))
+
+class Metrics:
+    """カウンター/ゲージ/ヒストグラムを集計し，Prometheusのテキスト形式で出力するクラス
+
+    値の更新はイベントループ上で行い，出力はWebサーバーのスレッドから呼ばれるため
+    ロックで保護する．キャッシュやキューの状態は collect() で定期的に取り込む．
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}  # name -> (種類, 説明)
+        self._values = {}  # (name, labels) -> 値
+        self._histograms = {}  # (name, labels) -> [バケットごとの件数 (累積しない)..., 合計, 件数]
+        self._buckets = {}  # name -> バケットの境界
+        self._collectors = []
+        self.last_sample = None
+
+    def describe(self, name, kind, help_text, buckets=LATENCY_BUCKETS):
+        self._types[name] = (kind, help_text)
+        if kind == 'histogram':
+            self._buckets[name] = buckets
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, self._labels(labels))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._buckets[name]
+        key = (name, self._labels(labels))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 2)
+            # 値が収まる最初のバケットだけに数え，累積は render() で行う
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """with ブロックの所要時間を dis_stage_seconds に記録する (await を挟んでもよい)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('dis_stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def add_collector(self, collector):
+        """collect() のたびに呼ばれ，(名前, 値, ラベル) を返す関数を登録する"""
+        self._collectors.append(collector)
+
+    def collect(self):
+        for collector in self._collectors:
+            try:
+                for name, value, labels in collector():
+                    self.set(name, value, **labels)
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted((key, list(series)) for key, series in self._histograms.items())
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._types:
+                kind, help_text = self._types[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+
+        for (name, labels), value in values:
+            header(name)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), series in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(self._buckets[name], series):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {series[-2]}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {series[-1]}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('dis_stage_seconds', 'histogram', 'Latency of each media processing stage.')
+metrics.describe('dis_downloaded_bytes_total', 'counter', 'Image bytes downloaded from upstreams.')
+metrics.describe('dis_upstream_failures_total', 'counter', 'Failed upstream requests by upstream and reason.')
+metrics.describe('dis_event_loop_lag_seconds', 'gauge', 'Most recent event loop lag sample.')
+metrics.describe('dis_event_loop_lag_sample_seconds', 'histogram', 'Distribution of event loop lag samples.')
+metrics.describe('dis_gateway_latency_seconds', 'gauge', 'Discord gateway heartbeat latency.')
+metrics.describe('dis_cache', 'gauge', 'Cache statistics by cache and field.')
+metrics.describe('dis_media_queue', 'gauge', 'Media job queue statistics by field.')
+metrics.describe('dis_media_workers', 'gauge', 'Media worker process statistics by field (gateway mode).')
+
+def upstream_label(url):
+    """画像URLを失敗数のラベル用の上流名にまとめる (ホスト名をそのまま使うと種類が増えすぎる)"""
+    return {'pixiv': 'pixiv_image', 'twitter': 'twitter_image'}.get(header_profile_for_url(url), 'other_image')
+
+async def sample_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL):
+    """一定間隔で眠り，予定より遅れて起きた時間をイベントループの遅延として記録する"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - start - interval, 0.0)
+        metrics.set('dis_event_loop_lag_seconds', lag)
+        metrics.observe('dis_event_loop_lag_sample_seconds', lag)
+        metrics.collect()
+        metrics.last_sample = time.monotonic()
+
+# -----------------------------------------------------------------------------
+# 大きすぎる画像の縮小 (別プロセスで実行する)
+# -----------------------------------------------------------------------------
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", 1))  # 0 で無効
+# 縮小を試みる元画像の上限 (展開時のメモリ使用量を抑えるため，送信上限より少し大きい程度にする)
+TRANSCODE_MAX_SOURCE_BYTES = int(os.environ.get("TRANSCODE_MAX_SOURCE_BYTES", 32 * 1024 * 1024))
+# 展開する画像の画素数の上限 (RGBAで約4バイト/画素のメモリを使う)
+TRANSCODE_MAX_PIXELS = int(os.environ.get("TRANSCODE_MAX_PIXELS", 40_000_000))
+TRANSCODE_JPEG_QUALITY = int(os.environ.get("TRANSCODE_JPEG_QUALITY", 92))
+TRANSCODE_MIN_JPEG_QUALITY = int(os.environ.get("TRANSCODE_MIN_JPEG_QUALITY", 75))
+IMAGE_SIGNATURES = ((b'\x89PNG', 'png'), (b'\xff\xd8', 'jpg'), (b'GIF8', 'gif'), (b'RIFF', 'webp'))
+
+def blob_size(blob):
+    return len(blob) if isinstance(blob, bytes) else os.path.getsize(blob)
+
+def sniff_image_extension(blob):
+    """先頭のバイト列から画像の拡張子を推測する．分からなければNone"""
+    if isinstance(blob, bytes):
+        head = blob[:8]
+    else:
+        with open(blob, 'rb') as f:
+            head = f.read(8)
+    for signature, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+class ImageTranscoder:
+    """大きすぎる画像をプロセスプールで再エンコードするクラス
+
+    Pillow が無いか TRANSCODE_WORKERS が 0 の場合は無効になり，
+    従来どおりサイズ超過として扱われる．
+    """
+
+    def __init__(self, workers=TRANSCODE_WORKERS, max_bytes=MAX_FILE_SIZE,
+                 max_source_bytes=TRANSCODE_MAX_SOURCE_BYTES, max_pixels=TRANSCODE_MAX_PIXELS,
+                 quality=TRANSCODE_JPEG_QUALITY, min_quality=TRANSCODE_MIN_JPEG_QUALITY):
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_source_bytes = max_source_bytes
+        self.max_pixels = max_pixels
+        self.quality = quality
+        self.min_quality = min_quality
+        self.enabled = Image is not None and workers > 0
+        self._executor = None
+
+    async def transcode(self, blob):
+        """blob を max_bytes 以下に収めた (バイト列, 拡張子) を返す．収まらなければNone"""
+        if self._executor is None:
+            # スレッドやsqliteのロックを抱えたまま複製されないよう fork ではなく spawn で起動する．
+            # spawn の子プロセスは起動スクリプトを読み込み直すため，run.py から起動すれば
+            # 子プロセスが読み込むのは image_transcode だけになる
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+            )
+        executor = self._executor
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.time('transcode'):
+                return await loop.run_in_executor(
+                    executor, transcode_image, blob, self.max_bytes, self.quality, self.min_quality, self.max_pixels
+                )
+        except concurrent.futures.process.BrokenProcessPool:
+            # プールのプロセスが落ちる (メモリ不足で強制終了されるなど) とプールは二度と使えないため，
+            # 捨てておき次の呼び出しで作り直す
+            if self._executor is executor:
+                print("Transcode pool is broken. It will be restarted on the next request.")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            raise
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
 
 # -----------------------------------------------------------------------------
 # Flask (Render用Webサーバー)
@@ -43,6 +1314,25 @@ def hello():
     """Renderが正常に起動しているかUptimeRobotが確認するためのルート"""
     return "Discord Bot is active and running in a unified process."
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheusのテキスト形式でメトリクスを返すルート"""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/healthz')
+def healthz():
+    """Gatewayに接続済みで，イベントループが止まっていなければ200を返すルート"""
+    problems = []
+    if bot.is_closed() or not bot.is_ready():
+        problems.append("gateway not ready")
+    elif not gateway_connected():
+        problems.append("gateway disconnected")
+    if metrics.last_sample is None or time.monotonic() - metrics.last_sample > EVENT_LOOP_STALL_SECONDS:
+        problems.append("event loop stalled")
+    if problems:
+        return ", ".join(problems), 503
+    return "ok", 200
+
 # -----------------------------------------------------------------------------
 # Discordボットの設定
 # -----------------------------------------------------------------------------
@@ -50,11 +1340,144 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.reactions = True
 
+# シャード数を指定するとAutoShardedBotで接続する ('auto' ならDiscordの推奨数．空ならシャーディングしない)
+DISCORD_SHARD_COUNT = os.environ.get("DISCORD_SHARD_COUNT", "")
+# このプロセスが受け持つシャードID (カンマ区切り．空なら全シャード．複数のGatewayプロセスで分担する場合に使う)
+DISCORD_SHARD_IDS = os.environ.get("DISCORD_SHARD_IDS", "")
+
+def shard_config_error():
+    """シャーディングの設定に誤りがあればその説明を返す (問題なければ None)"""
+    if DISCORD_SHARD_COUNT and DISCORD_SHARD_COUNT != 'auto' and not (DISCORD_SHARD_COUNT.isdigit() and int(DISCORD_SHARD_COUNT) > 0):
+        return f"DISCORD_SHARD_COUNT は 'auto' か正の整数で指定してください: {DISCORD_SHARD_COUNT}"
+    if not DISCORD_SHARD_IDS:
+        return None
+    if not DISCORD_SHARD_COUNT or DISCORD_SHARD_COUNT == 'auto':
+        return "DISCORD_SHARD_IDS を使う場合は DISCORD_SHARD_COUNT に全体のシャード数を指定してください ('auto' や未指定は不可)．"
+    shard_ids = [shard_id.strip() for shard_id in DISCORD_SHARD_IDS.split(',')]
+    if not all(shard_id.isdigit() and int(shard_id) < int(DISCORD_SHARD_COUNT) for shard_id in shard_ids):
+        return f"DISCORD_SHARD_IDS は 0 以上 {DISCORD_SHARD_COUNT} 未満の整数をカンマ区切りで指定してください: {DISCORD_SHARD_IDS}"
+    return None
+
+# 設定に誤りがあれば，Botはシャーディングせずに作っておき，起動時にエラーを表示して止める
+SHARD_CONFIG_ERROR = shard_config_error()
+
+def bot_options():
+    """commands.Bot に渡す引数を返す"""
+    options = {'command_prefix': "!", 'intents': intents}
+    if SHARD_CONFIG_ERROR:
+        return options
+    if DISCORD_SHARD_COUNT and DISCORD_SHARD_COUNT != 'auto':
+        options['shard_count'] = int(DISCORD_SHARD_COUNT)
+    if DISCORD_SHARD_IDS:
+        options['shard_ids'] = [int(shard_id) for shard_id in DISCORD_SHARD_IDS.split(',')]
+    return options
+
+class MediaBot(commands.AutoShardedBot if DISCORD_SHARD_COUNT and not SHARD_CONFIG_ERROR else commands.Bot):
+    """終了時に共有リソースを片付けるための commands.Bot (シャード数の指定があれば AutoShardedBot)"""
+
+    _cleanup_task = None
+
+    async def close(self):
+        # シグナルと bot.run() の終了処理の両方から呼ばれるため，片付けは1回だけ行う
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._close_resources())
+        await self._cleanup_task
+        await super().close()
+
+    async def _close_resources(self):
+        if self.lag_sampler is not None:
+            self.lag_sampler.cancel()
+        await self.media_jobs.close()
+        if self.media_workers is not None:
+            await self.media_workers.close()
+        await self.user_settings.close()
+        await self.http_pool.close()
+        self.image_cache.close()
+        self.image_transcoder.close()
+        if self.web_server is not None:
+            self.web_shutdown.set()
+            try:
+                await asyncio.wait_for(self.web_server, WEB_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"Web server did not stop in {WEB_SHUTDOWN_TIMEOUT}s.")
+
 # discord.Client の代わりに commands.Bot を使用．コマンド管理が容易になる．
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = MediaBot(**bot_options())
+
+# 実行モード (起動時にコマンドライン引数で上書きできる)
+bot.run_mode = RUN_MODE
+
+# 外部API/画像取得用のコネクションプール (setup_hookで開始し，closeで破棄する)
+bot.http_pool = HttpPool()
+
+# イベントループ遅延の計測タスク (setup_hookで開始する)
+bot.lag_sampler = None
+
+# Webサーバーのタスクと，その停止の合図 (シグナルはBotの終了処理で扱うため，hypercornには任せない)
+WEB_SHUTDOWN_TIMEOUT = float(os.environ.get("WEB_SHUTDOWN_TIMEOUT", 5.0))
+bot.web_server = None
+bot.web_shutdown = asyncio.Event()
+# シグナルで始めた終了処理のタスク
+bot.shutdown_task = None
+
+# fxtwitter/phixiv の解決結果キャッシュ (ツイートID/作品IDがキー)
+bot.resolve_cache = AsyncTTLCache(RESOLVE_CACHE_SIZE, RESOLVE_CACHE_TTL, RESOLVE_CACHE_NEGATIVE_TTL)
+
+# リアクション保存用: REST APIで取得したメッセージ，対応リンクを含むかの索引，最近保存した (メッセージ, ユーザー) の組
+bot.reaction_messages = AsyncTTLCache(REACTION_MESSAGE_CACHE_SIZE, REACTION_MESSAGE_CACHE_TTL, REACTION_MESSAGE_CACHE_TTL)
+bot.link_messages = ExpiringDict(LINK_MESSAGE_INDEX_SIZE, LINK_MESSAGE_INDEX_TTL)
+bot.recent_reaction_saves = ExpiringDict(LINK_MESSAGE_INDEX_SIZE, REACTION_SAVE_DEDUP_WINDOW)
 
-# ★変更点: 起動時に一度だけ設定を読み込み，botオブジェクトに属性として持たせる
-bot.user_settings = load_user_settings()
+# ダウンロード済み画像のキャッシュ (チャンネル/DM/リアクション保存で共有する)
+bot.image_cache = ImageCache(IMAGE_CACHE_MEMORY_BYTES, IMAGE_CACHE_DIR, IMAGE_CACHE_DISK_BYTES)
+
+# pixivの作品IDごとに判明した原寸画像の拡張子
+bot.pixiv_extensions = PixivExtensionResolver(bot.http_pool)
+
+# 大きすぎる画像を縮小するプロセスプール (初回使用時に起動し，closeで停止する)
+bot.image_transcoder = ImageTranscoder()
+
+# リンク処理のジョブキュー (ワーカーはsetup_hookで起動し，closeで処理しきってから止める)
+bot.media_jobs = MediaJobQueue()
+
+# gateway モードでジョブを渡すワーカープロセスのプール (それ以外のモードではNone)
+bot.media_workers = None
+
+def gateway_connected():
+    """全てのシャード (シャーディングしない場合はGateway) に接続中ならTrueを返す"""
+    if isinstance(bot, commands.AutoShardedBot):
+        return bool(bot.shards) and all(
+            not shard.is_closed() and math.isfinite(shard.latency) for shard in bot.shards.values()
+        )
+    return bot.ws is not None and math.isfinite(bot.latency)
+
+def collect_bot_metrics():
+    """キャッシュ/キュー/Gatewayの状態をメトリクスとして返す (イベントループ上で呼ばれる)"""
+    caches = {
+        'resolve': bot.resolve_cache.stats(),
+        'reaction_message': bot.reaction_messages.stats(),
+        'image': bot.image_cache.stats(),
+    }
+    for cache_name, stats in caches.items():
+        for field, value in stats.items():
+            yield 'dis_cache', value, {'cache': cache_name, 'field': field}
+    for field, value in bot.media_jobs.stats().items():
+        if field != 'guilds':
+            yield 'dis_media_queue', value, {'field': field}
+    if bot.media_workers is not None:
+        for field, value in bot.media_workers.stats().items():
+            yield 'dis_media_workers', value, {'field': field}
+    if isinstance(bot, commands.AutoShardedBot):
+        for shard_id, shard in bot.shards.items():
+            if math.isfinite(shard.latency):
+                yield 'dis_gateway_latency_seconds', shard.latency, {'shard': str(shard_id)}
+    elif math.isfinite(bot.latency):
+        yield 'dis_gateway_latency_seconds', bot.latency, {}
+
+metrics.add_collector(collect_bot_metrics)
+
+# ★変更点: 設定ストアをbotオブジェクトに属性として持たせる (読み込みはsetup_hookで行う)
+bot.user_settings = UserSettingsStore(SETTINGS_DB_FILE)
 
 # (SHOT_TYPE, STICKER, GACHA_* 定数は変更なし)
 SHOT_TYPE = (
@@ -83,6 +1506,71 @@ GACHA_STAR_3 = ("<:rainbowjunya2:930782219490983937>",)
 GACHA_ITEMS = [GACHA_STAR_1, GACHA_STAR_2, GACHA_STAR_3, STICKER]
 GACHA_WEIGHTS_NORMAL = [78.5, 18.5, 2.3, 0.7]
 GACHA_WEIGHTS_GUARANTEED = [0, 18.5 + 78.5, 2.3, 0.7]
+GACHA_RARITY_NAMES = ("★1", "★2", "★3", "スタンプ")
+GACHA_RARE_CATEGORY = 2  # 天井カウンターの対象 (★3)
+GACHA_MAX_PULLS = int(os.environ.get("GACHA_MAX_PULLS", 100000))
+GACHA_HISTORY_SETTING = 'gacha'  # ユーザー設定ストアに保存する引いた回数の記録
+
+# -----------------------------------------------------------------------------
+# ガチャ
+# -----------------------------------------------------------------------------
+class GachaEngine:
+    """重み付きのガチャ抽選を行うクラス
+
+    重みのプロファイル (通常/確定枠) ごとに累積重みを一度だけ計算しておき，
+    何回分でも random.choices の1回の呼び出しでまとめて抽選する．
+    seed を指定すると結果を再現できる．
+    """
+
+    def __init__(self, items, profiles, seed=None):
+        self.items = items
+        self.categories = range(len(items))
+        self.rng = random.Random(seed)
+        self._cum_weights = {name: list(itertools.accumulate(weights)) for name, weights in profiles.items()}
+
+    def draw_categories(self, n, profile='normal'):
+        """n 回分のカテゴリ番号を抽選する"""
+        return self.rng.choices(self.categories, cum_weights=self._cum_weights[profile], k=n)
+
+    def pick(self, category):
+        return self.rng.choice(self.items[category])
+
+    def pull_categories(self, n):
+        """10回ごとに1回を確定枠とした n 回分のカテゴリ番号を引いた順に返す"""
+        normal = self.draw_categories(n - n // 10, 'normal')
+        guaranteed = self.draw_categories(n // 10, 'guaranteed')
+        results = []
+        for i in range(n // 10):
+            results.extend(normal[i * 9:(i + 1) * 9])
+            results.append(guaranteed[i])
+        results.extend(normal[(n // 10) * 9:])
+        return results
+
+    def summarize(self, categories):
+        """カテゴリ番号の列から，レア度ごとの件数と最後の★3より後に引いた回数を求める
+
+        ★3が1回も出ていなければ回数は None を返す．
+        """
+        counts = [0] * len(self.items)
+        for category in categories:
+            counts[category] += 1
+        since_rare = None
+        for i in range(len(categories) - 1, -1, -1):
+            if categories[i] == GACHA_RARE_CATEGORY:
+                since_rare = len(categories) - 1 - i
+                break
+        return counts, since_rare
+
+    def bulk_pull(self, n):
+        """n 回引いて，summarize() の結果を返す"""
+        return self.summarize(self.pull_categories(n))
+
+gacha = GachaEngine(
+    GACHA_ITEMS,
+    {'normal': GACHA_WEIGHTS_NORMAL, 'guaranteed': GACHA_WEIGHTS_GUARANTEED},
+    seed=os.environ.get("GACHA_SEED"),
+)
+
 
 # -----------------------------------------------------------------------------
 # UIコンポーネント
@@ -102,64 +1590,236 @@ class DeleteButtonView(discord.ui.View):
 # -----------------------------------------------------------------------------
 # ヘルパー関数
 # -----------------------------------------------------------------------------
-async def download_and_send_images(destination, image_url_groups, fallback_channel, mention_user, original_url=None):
+UPLOAD_CHUNK_SIZE = 10  # Discordの1メッセージあたりの添付上限
+# 1メッセージにまとめて添付する合計サイズの上限
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 25 * 1024 * 1024))
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+# 画像ダウンロードの同時実行数 (全体とホストごと)
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 8))
+DOWNLOAD_CONCURRENCY_PER_HOST = int(os.environ.get("DOWNLOAD_CONCURRENCY_PER_HOST", 4))
+# ダウンロード中の画像がメモリ上で占有してよい合計バイト数
+DOWNLOAD_MEMORY_BUDGET = int(os.environ.get("DOWNLOAD_MEMORY_BUDGET", 32 * 1024 * 1024))
+# 1回の送信で，まだ送っていない画像を何枚先まで取得してよいか (取得済みの画像は送信までメモリに残るため)
+DOWNLOAD_WINDOW = max(UPLOAD_CHUNK_SIZE, int(os.environ.get("DOWNLOAD_WINDOW", 2 * UPLOAD_CHUNK_SIZE)))
+download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+download_host_semaphores = {}
+
+class ImageTooLarge(Exception):
+    """画像が MAX_FILE_SIZE を超えていたことを示す例外"""
+
+    def __init__(self, size):
+        super().__init__(f"{size} bytes")
+        self.size = size
+
+class ImageTranscodeError(Exception):
+    """上限を超えた画像を縮小しようとして，画像として読めなかった場合の例外"""
+
+class ByteBudget:
+    """同時に確保できるバイト数の上限．空きが無ければ解放されるまで待たせる"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes):
+        # 上限より大きい要求は上限まで切り詰め，単独でなら実行できるようにする
+        nbytes = min(nbytes, self.limit)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_use + nbytes <= self.limit)
+            self.in_use += nbytes
+        try:
+            yield
+        finally:
+            self.in_use -= nbytes
+            async with self._condition:
+                self._condition.notify_all()
+
+download_budget = ByteBudget(DOWNLOAD_MEMORY_BUDGET)
+
+@contextlib.asynccontextmanager
+async def download_slot(url):
+    """全体とホストごとの同時ダウンロード数を制限する"""
+    host = urlsplit(url).hostname or ''
+    host_semaphore = download_host_semaphores.get(host)
+    if host_semaphore is None:
+        host_semaphore = download_host_semaphores[host] = asyncio.Semaphore(DOWNLOAD_CONCURRENCY_PER_HOST)
+    async with download_semaphore, host_semaphore:
+        yield
+
+async def stream_image(img_url, writer, max_bytes=MAX_FILE_SIZE):
+    """画像を少しずつ読み込んで writer に書き込む．200以外の応答ならFalseを返す
+
+    Content-Length が max_bytes を超えていれば本文を読まずに ImageTooLarge を送出し，
+    長さが不明な場合も読み込み中に上限を超えた時点で打ち切る．
+    """
+    upstream = upstream_label(img_url)
+    async with download_slot(img_url):
+        try:
+            with metrics.time('download'):
+                async with bot.http_pool.get(img_url) as img_resp:
+                    if img_resp.status != 200:
+                        metrics.inc('dis_upstream_failures_total', upstream=upstream, reason=f'http_{img_resp.status}')
+                        return False
+                    content_length = img_resp.content_length
+                    if content_length is not None and content_length > max_bytes:
+                        raise ImageTooLarge(content_length)
+
+                    # メモリに溜まるのは spool の閾値までなので，その分だけ予算を確保する
+                    expected = content_length if content_length is not None else writer.max_memory_bytes
+                    async with download_budget.reserve(min(expected, writer.max_memory_bytes)):
+                        async for chunk in img_resp.content.iter_chunked(DOWNLOAD_CHUNK_BYTES):
+                            if writer.size + len(chunk) > max_bytes:
+                                raise ImageTooLarge(writer.size + len(chunk))
+                            await writer.write(chunk)
+                            metrics.inc('dis_downloaded_bytes_total', len(chunk))
+                    return True
+        except ImageTooLarge:
+            metrics.inc('dis_upstream_failures_total', upstream=upstream, reason='too_large')
+            raise
+        except Exception as e:
+            metrics.inc('dis_upstream_failures_total', upstream=upstream, reason=type(e).__name__)
+            raise
+
+async def shrink_image(img_url, blob, filename):
+    """上限を超える画像を縮小したものと，形式に合わせたファイル名を返す
+
+    縮小結果は元のURLごとに画像キャッシュへ保存し，同じ画像を何度も縮小しない．
+    縮小しても収まらなければ ImageTooLarge を，読み込めない画像 (展開すると大きすぎる
+    画像を含む) なら ImageTranscodeError を送出する．
+    """
+    original_size = blob_size(blob)
+
+    async def write_transcoded(writer):
+        try:
+            result = await bot.image_transcoder.transcode(blob)
+        except Exception as e:
+            raise ImageTranscodeError(f"{type(e).__name__}: {e}") from e
+        if result is None:
+            return False
+        await writer.write(result[0])
+        print(f"Shrunk {img_url} from {original_size} to {len(result[0])} bytes.")
+        return True
+
+    shrunk = await bot.image_cache.fetch(f"transcoded:{img_url}", write_transcoded)
+    if shrunk is None:
+        raise ImageTooLarge(original_size)
+    extension = sniff_image_extension(shrunk)
+    if extension is not None:
+        filename = f"{os.path.splitext(filename)[0]}.{extension}"
+    return shrunk, filename
+
+async def download_image_group(index, url_group, fallback_channel):
+    """1枚分のURL候補を順に試し，取得できたdiscord.Fileを返す (失敗時はNone)"""
+    # 縮小できる場合は上限を超える画像も取得し，送信前に縮小する
+    transcoder = bot.image_transcoder
+    source_limit = transcoder.max_source_bytes if transcoder.enabled else MAX_FILE_SIZE
+    for img_url in url_group:
+        filename = os.path.basename(img_url.split('?')[0])
+        try:
+            blob = await bot.image_cache.fetch(img_url, lambda writer: stream_image(img_url, writer, source_limit))
+            if blob is None:
+                continue
+            bot.pixiv_extensions.observe(img_url)
+            if blob_size(blob) > MAX_FILE_SIZE:
+                blob, filename = await shrink_image(img_url, blob, filename)
+            return image_file(blob, filename)
+        except ImageTooLarge as e:
+            await fallback_channel.send(f"画像 {index+1} はサイズが大きすぎるため、送信できません。({e.size / 1024 / 1024:.2f}MB)")
+            return None
+        except ImageTranscodeError as e:
+            print(f"Failed to shrink {img_url}: {e}")
+            await fallback_channel.send(f"画像 {index+1} はサイズが大きすぎ、縮小にも失敗したため送信できません。")
+            return None
+        except Exception as dl_error:
+            print(f"Attempt failed for {img_url}: {dl_error}")
+            continue
+
+    await fallback_channel.send(f"画像 {index+1} のダウンロードに全ての拡張子で失敗しました。")
+    return None
+
+def file_size(file):
+    """discord.File の残りのバイト数を返す"""
+    fp = file.fp
+    position = fp.tell()
+    size = fp.seek(0, os.SEEK_END)
+    fp.seek(position)
+    return size - position
+
+async def download_and_send_images(destination, image_url_groups, fallback_channel, mention_user, original_urls=None):
+    """画像をダウンロードし，枚数と合計サイズの上限に収まるようにまとめて送信する
+
+    original_urls は各グループの元のURLのリスト．DMに送る場合は，それぞれの
+    元のURLを，その画像を最初に含むメッセージの本文に添える．
+    """
     if not image_url_groups:
         return False
 
-    files_to_send = []
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36',
-            'Referer': 'https://www.pixiv.net/'
-        }
-        async with aiohttp.ClientSession(headers=headers) as session:
-            MAX_FILE_SIZE = 24 * 1024 * 1024
-            for i, url_group in enumerate(image_url_groups):
-                download_success = False
-                for img_url in url_group:
-                    try:
-                        async with session.get(img_url) as img_resp:
-                            if img_resp.status == 200:
-                                image_data = await img_resp.read()
-                                if len(image_data) > MAX_FILE_SIZE:
-                                    await fallback_channel.send(f"画像 {i+1} はサイズが大きすぎるため、送信できません。({len(image_data) / 1024 / 1024:.2f}MB)")
-                                    download_success = True
-                                    break
-                                
-                                filename = os.path.basename(img_url.split('?')[0])
-                                files_to_send.append(discord.File(io.BytesIO(image_data), filename=filename))
-                                download_success = True
-                                break
-                    except Exception as dl_error:
-                        print(f"Attempt failed for {img_url}: {dl_error}")
-                        continue
-                
-                if not download_success:
-                    await fallback_channel.send(f"画像 {i+1} のダウンロードに全ての拡張子で失敗しました。")
-    except Exception as e:
-        print(f"画像ダウンロード中に予期せぬエラーが発生しました: {e}")
-        traceback.print_exc()
-        await fallback_channel.send(f"画像ダウンロード中に予期せぬエラーが発生しました: `{type(e).__name__}`")
-        return False
+    # ダウンロードは送信位置から DOWNLOAD_WINDOW 枚先までだけ並行して進め，先頭から順に揃った分だけ送信していく．
+    # 全ページを一度に取得すると，送信を待つ画像が全てメモリに溜まってしまう
+    pending_groups = enumerate(image_url_groups)
+    download_tasks = deque()
 
-    if not files_to_send:
-        if any(image_url_groups):
-             return True
-        return False
+    def fill_download_window(unsent):
+        room = max(0, DOWNLOAD_WINDOW - len(download_tasks) - unsent)
+        for i, url_group in itertools.islice(pending_groups, room):
+            download_tasks.append((i, asyncio.create_task(download_image_group(i, url_group, fallback_channel))))
 
     is_dm_target = isinstance(destination, (discord.User, discord.Member))
+    view = DeleteButtonView() if is_dm_target else None
+    sent_count = 0
+    announced_urls = set()
+
+    async def send_chunk(chunk):
+        nonlocal sent_count
+        content_to_send = None
+        if is_dm_target and original_urls:
+            headers = []
+            for index, _ in chunk:
+                original_url = original_urls[index]
+                if original_url and original_url not in announced_urls:
+                    announced_urls.add(original_url)
+                    headers.append(f"<{original_url}>")
+            content_to_send = "\n".join(headers) or None
+        with metrics.time('upload'):
+            await destination.send(content=content_to_send, files=[file for _, file in chunk], view=view)
+        sent_count += len(chunk)
 
     try:
-        view = DeleteButtonView() if is_dm_target else None
-        for i in range(0, len(files_to_send), 10):
-            chunk = files_to_send[i:i+10]
-            content_to_send = None
-            if is_dm_target and i == 0 and original_url:
-                content_to_send = f"<{original_url}>"
-            
-            await destination.send(content=content_to_send, files=chunk, view=view)
-        print(f"Sent {len(files_to_send)} images to {destination}.")
-        return True
+        # 枚数と合計サイズの両方が上限に収まるように詰めて送る
+        chunk = []
+        chunk_bytes = 0
+        fill_download_window(0)
+        while download_tasks:
+            index, task = download_tasks.popleft()
+            try:
+                downloaded = await task
+            except Exception as e:
+                print(f"画像ダウンロード中に予期せぬエラーが発生しました: {e}")
+                traceback.print_exc()
+                await fallback_channel.send(f"画像ダウンロード中に予期せぬエラーが発生しました: `{type(e).__name__}`")
+                return False
+
+            if downloaded is None:
+                fill_download_window(len(chunk))
+                continue
+            size = file_size(downloaded)
+            if chunk and chunk_bytes + size > UPLOAD_MAX_BYTES:
+                await send_chunk(chunk)
+                chunk = []
+                chunk_bytes = 0
+            chunk.append((index, downloaded))
+            chunk_bytes += size
+            if len(chunk) == UPLOAD_CHUNK_SIZE:
+                await send_chunk(chunk)
+                chunk = []
+                chunk_bytes = 0
+            fill_download_window(len(chunk))
+
+        if chunk:
+            await send_chunk(chunk)
     except discord.Forbidden:
         if is_dm_target:
             print(f"Failed to send DM to {destination}. Sending to channel instead.")
@@ -172,73 +1832,166 @@ async def download_and_send_images(destination, image_url_groups, fallback_chann
         traceback.print_exc()
         await fallback_channel.send(f"画像の送信中に予期せぬエラーが発生しました: `{type(e).__name__}`")
         return False
+    finally:
+        for _, task in download_tasks:
+            if not task.done():
+                task.cancel()
+
+    if sent_count == 0:
+        return any(image_url_groups)
+
+    print(f"Sent {sent_count} images to {destination}.")
+    return True
+
+# 画像の取得元 (ベンチマーク等でローカルの代替サーバーに向けられるよう環境変数で変更できる)
+FXTWITTER_API_BASE = os.environ.get("FXTWITTER_API_BASE", "https://api.fxtwitter.com")
+PHIXIV_API_BASE = os.environ.get("PHIXIV_API_BASE", "https://www.phixiv.net")
+PIXIV_IMAGE_BASE = os.environ.get("PIXIV_IMAGE_BASE", "https://i.pixiv.re")
+
+TWITTER_URL_PATTERN = re.compile(r'(https?://(?:www\.)?(?:x|twitter)\.com/(\w+/status/(\d+)))')
+PIXIV_URL_PATTERN = re.compile(r'(https?://(?:www\.)?pixiv\.net/(?:en/)?artworks/(\d+))')
+PIXIV_PROXY_PATH_PATTERN = re.compile(r'/img/(\d{4}/\d{2}/\d{2}/\d{2}/\d{2}/\d{2})/(\d+)_p(\d+)')
+# 両方のリンクを出現順に1回の走査で拾うためのパターン
+MEDIA_LINK_PATTERN = re.compile(f"{TWITTER_URL_PATTERN.pattern}|{PIXIV_URL_PATTERN.pattern}")
+# 1メッセージから解決するリンク数の上限 (大量のリンクで上流APIを叩きすぎないため)
+MEDIA_LINKS_PER_MESSAGE = int(os.environ.get("MEDIA_LINKS_PER_MESSAGE", 10))
+
+def extract_media_links(content):
+    """メッセージ中の対応リンクを出現順に (キャッシュキー, 元のURL, ローダー) のリストで返す
+
+    x.com と twitter.com のように表記が違っても同じ投稿は1つにまとめる．
+    """
+    links = {}
+    for url_match in MEDIA_LINK_PATTERN.finditer(content):
+        twitter_url, status_part, status_id, pixiv_url, artwork_id = url_match.groups()
+        if twitter_url:
+            key = f"twitter:{status_id}"
+            if key not in links:
+                links[key] = (twitter_url, lambda status_part=status_part: fetch_twitter_media(status_part))
+        else:
+            key = f"pixiv:{artwork_id}"
+            if key not in links:
+                links[key] = (pixiv_url, lambda artwork_id=artwork_id: fetch_pixiv_pages(artwork_id))
+        if len(links) == MEDIA_LINKS_PER_MESSAGE:
+            break
+    return [(key, original_url, loader) for key, (original_url, loader) in links.items()]
+
+def find_media_link(content):
+    """メッセージ中の最初の対応リンクを返す．無ければNone"""
+    url_match = MEDIA_LINK_PATTERN.search(content)
+    return url_match.group(0) if url_match else None
+
+def media_link_key(message):
+    """メッセージ中の対応リンクの組を表すキーを返す (ジョブの重複判定に使う)"""
+    return tuple(key for key, _, _ in extract_media_links(message.content)) or message.id
+
+async def fetch_twitter_media(status_part):
+    """fxtwitterのAPIからツイートの画像URLのグループを取得する"""
+    image_url_groups = []
+    api_url = f"{FXTWITTER_API_BASE}/{status_part}"
+    try:
+        async with bot.http_pool.get(api_url, profile='twitter') as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                media_list = data.get('tweet', {}).get('media', {}).get('all', [])
+                for media in media_list:
+                    image_url_groups.append([media['url']])
+            else:
+                metrics.inc('dis_upstream_failures_total', upstream='fxtwitter', reason=f'http_{resp.status}')
+    except Exception as e:
+        metrics.inc('dis_upstream_failures_total', upstream='fxtwitter', reason=type(e).__name__)
+        raise
+    return image_url_groups
+
+async def fetch_pixiv_pages(artwork_id):
+    """phixivのAPIからpixiv作品の各ページの画像URL候補を取得する"""
+    image_url_groups = []
+    api_url = f"{PHIXIV_API_BASE}/api/info?id={artwork_id}"
+    try:
+        async with bot.http_pool.get(api_url, profile='default') as resp:
+            if resp.status != 200:
+                metrics.inc('dis_upstream_failures_total', upstream='phixiv', reason=f'http_{resp.status}')
+                return image_url_groups
+            data = await resp.json()
+    except Exception as e:
+        metrics.inc('dis_upstream_failures_total', upstream='phixiv', reason=type(e).__name__)
+        raise
+
+    proxy_urls = data.get("image_proxy_urls", [])
+    extension = None
+    for proxy_url in proxy_urls:
+        url_match = PIXIV_PROXY_PATH_PATTERN.search(proxy_url)
+        if url_match:
+            date_path, illust_id, page_num = url_match.groups()
+            base_url = f"{PIXIV_IMAGE_BASE}/img-original/img/{date_path}/{illust_id}_p{page_num}"
+            # 拡張子は先頭ページで一度だけ調べ，残りのページにも使い回す
+            if not image_url_groups:
+                extension = await bot.pixiv_extensions.resolve(illust_id, base_url, data)
+            image_url_groups.append(PixivExtensionResolver.candidates(base_url, extension))
+    return image_url_groups
 
 async def get_image_urls_from_message(content):
-    """メッセージの内容から画像URLのグループと元のURLを抽出する"""
+    """メッセージの内容から画像URLのグループと，各グループの元のURLを抽出する
+
+    メッセージ中の対応リンクを全て並行して解決し，出現順に1つのリストへまとめる．
+    一部のリンクの解決に失敗しても残りのリンクの画像は返す．
+    """
+    links = extract_media_links(content)
+    results = await asyncio.gather(
+        *(bot.resolve_cache.get_or_load(key, loader) for key, _, loader in links),
+        return_exceptions=True,
+    )
+
     image_url_groups = []
-    original_url = ""
-
-    # TwitterのURLをチェック
-    twitter_match = re.search(r'(https?://(?:www\.)?(?:x|twitter)\.com/\w+/status/\d+)', content)
-    if twitter_match:
-        original_url = twitter_match.group(1)
-        status_part_match = re.search(r'(\w+/status/\d+)', original_url)
-        if not status_part_match: return None, None
-        status_part = status_part_match.group(1)
-        api_url = f"https://api.fxtwitter.com/{status_part}"
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36'}
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.get(api_url) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    media_list = data.get('tweet', {}).get('media', {}).get('all', [])
-                    for media in media_list:
-                        image_url_groups.append([media['url']])
-        return image_url_groups, original_url
-
-    # PixivのURLをチェック
-    pixiv_match = re.search(r'(https?://(?:www\.)?pixiv\.net/(?:en/)?artworks/\d+)', content)
-    if pixiv_match:
-        original_url = pixiv_match.group(1)
-        artwork_id_match = re.search(r'artworks/(\d+)', original_url)
-        if not artwork_id_match: return None, None
-        artwork_id = artwork_id_match.group(1)
-        api_url = f"https://www.phixiv.net/api/info?id={artwork_id}"
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36'}
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.get(api_url) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    proxy_urls = data.get("image_proxy_urls", [])
-                    pattern = re.compile(r'/img/(\d{4}/\d{2}/\d{2}/\d{2}/\d{2}/\d{2})/(\d+)_p(\d+)')
-                    for proxy_url in proxy_urls:
-                        url_match = pattern.search(proxy_url)
-                        if url_match:
-                            date_path, illust_id, page_num = url_match.groups()
-                            base_url = f"https://i.pixiv.re/img-original/img/{date_path}/{illust_id}_p{page_num}"
-                            image_url_groups.append([f"{base_url}.png", f"{base_url}.jpg", f"{base_url}.gif"])
-        return image_url_groups, original_url
-
-    return None, None
-
-async def process_media_link(message, url_type):
+    original_urls = []
+    errors = []
+    for (_, original_url, _), result in zip(links, results):
+        if isinstance(result, Exception):
+            print(f"Failed to resolve {original_url}: {result}")
+            errors.append(result)
+            continue
+        image_url_groups.extend(bot.pixiv_extensions.reorder(url_group) for url_group in result)
+        original_urls.extend([original_url] * len(result))
+
+    # 全てのリンクが例外で失敗した場合は，これまで通り呼び出し元にエラーを伝える
+    if errors and len(errors) == len(links):
+        raise errors[0]
+    return image_url_groups, original_urls
+
+async def deliver_images(message, image_url_groups, original_urls=None, send_preference=None):
+    """チャンネルと (DM送信がONなら) 投稿者のDMへ並行して画像を送る
+
+    送信先ごとに独立して送るため，片方がレート制限で待たされても
+    もう片方の送信は遅れない．ダウンロードは画像キャッシュで共有される．
+    send_preference を省略した場合は投稿者の設定を参照する．
+    """
+    if send_preference is None:
+        # ★変更点: bot.user_settings を参照し，キーとして文字列のIDを使用
+        user_id = str(message.author.id)
+        send_preference = bot.user_settings.get(user_id, 'channel')
+
+    deliveries = [download_and_send_images(message.channel, image_url_groups, message.channel, message.author)]
+    if send_preference == 'dm':
+        deliveries.append(download_and_send_images(message.author, image_url_groups, message.channel, message.author, original_urls=original_urls))
+    await asyncio.gather(*deliveries)
+
+async def process_media_link(message, url_type, send_preference=None):
+    with metrics.time('media_total'):
+        await _process_media_link(message, url_type, send_preference)
+
+async def _process_media_link(message, url_type, send_preference=None):
     processing_emoji = "🤔"
     success_emoji = '❤️'
 
     try:
         await message.add_reaction(processing_emoji)
 
-        image_url_groups, original_url = await get_image_urls_from_message(message.content)
+        with metrics.time('media_resolve'):
+            image_url_groups, original_urls = await get_image_urls_from_message(message.content)
 
         if image_url_groups:
-            # ★変更点: bot.user_settings を参照し，キーとして文字列のIDを使用
-            user_id = str(message.author.id)
-            send_preference = bot.user_settings.get(user_id, 'channel')
-            
-            await download_and_send_images(message.channel, image_url_groups, message.channel, message.author)
-            
-            if send_preference == 'dm':
-                await download_and_send_images(message.author, image_url_groups, message.channel, message.author, original_url=original_url)
+            with metrics.time('media_deliver'):
+                await deliver_images(message, image_url_groups, original_urls=original_urls, send_preference=send_preference)
         else:
             await message.channel.send("このリンクからは画像を見つけられませんでした。")
 
@@ -256,39 +2009,203 @@ async def process_media_link(message, url_type):
         except discord.HTTPException:
             pass
 
-async def process_embed_images(message, embeds):
-    image_url_groups = []
-    for embed in embeds:
-        if embed.image and embed.image.url:
-            image_url_groups.append([embed.image.url])
+def embed_image_url_groups(embeds):
+    """埋め込みの画像URLをグループのリストにする"""
+    return [[embed.image.url] for embed in embeds if embed.image and embed.image.url]
 
+async def process_embed_images(message, image_url_groups, send_preference=None):
     if not image_url_groups:
         await message.channel.send("この埋め込みには保存できる画像が見つかりませんでした。", reference=message)
         return
-    
-    # ★変更点: bot.user_settings を参照し，キーとして文字列のIDを使用
-    user_id = str(message.author.id)
-    send_preference = bot.user_settings.get(user_id, 'channel')
-    
-    await download_and_send_images(message.channel, image_url_groups, message.channel, message.author)
-    
-    if send_preference == 'dm':
-        await download_and_send_images(message.author, image_url_groups, message.channel, message.author)
 
-def perform_gacha_draw(guaranteed=False):
-    weights = GACHA_WEIGHTS_GUARANTEED if guaranteed else GACHA_WEIGHTS_NORMAL
-    chosen_category = random.choices(GACHA_ITEMS, weights=weights, k=1)[0]
-    return random.choice(chosen_category)
+    with metrics.time('embed_deliver'):
+        await deliver_images(message, image_url_groups, send_preference=send_preference)
+
+async def save_reaction_images(channel, user, message_id, content):
+    """リアクションしたユーザーのDMへ，メッセージ中のリンクの画像を送る"""
+    with metrics.time('reaction_resolve'):
+        image_url_groups, original_urls = await get_image_urls_from_message(content)
+
+    if image_url_groups:
+        print(f"Processing reaction save for {user.name} on message {message_id}")
+        with metrics.time('reaction_deliver'):
+            await download_and_send_images(user, image_url_groups, channel, user, original_urls=original_urls)
+
+def remote_message_fields(message):
+    """ワーカープロセスでメッセージを処理するのに必要な情報を返す"""
+    return {
+        'channel_id': message.channel.id,
+        'message_id': message.id,
+        'author_id': message.author.id,
+        'content': message.content,
+        'send_preference': bot.user_settings.get(str(message.author.id), 'channel'),
+    }
+
+async def run_media_job(remote_job, job_factory):
+    """gateway モードではワーカープロセスで，それ以外ではこのプロセスでジョブを実行する"""
+    if bot.media_workers is None:
+        return await job_factory()
+    return await bot.media_workers.run(remote_job, job_factory)
+
+async def enqueue_media_job(message, key, job_factory, remote_job=None):
+    """メディア処理をジョブキューに登録する．混雑していれば利用者にその旨を返信する
+
+    remote_job を渡すと，gateway モードではその内容をワーカープロセスへ送って処理させる．
+    """
+    guild_id = message.guild.id if message.guild else 0
+    if remote_job is not None:
+        local_job_factory = job_factory
+        job_factory = lambda: run_media_job(remote_job, local_job_factory)
+    status = bot.media_jobs.submit(guild_id, message.author.id, key, job_factory)
+    if status == MediaJobQueue.BUSY:
+        await message.channel.send("現在処理が混み合っています。しばらくしてからもう一度お試しください。", reference=message)
+    return status
+
+def record_gacha_history(user_id, counts, since_rare):
+    """ユーザーごとの累計件数と，最後に★3を引いてからの回数 (天井カウンター) を更新する"""
+    history = bot.user_settings.get_setting(user_id, GACHA_HISTORY_SETTING) or {}
+    total_counts = history.get('counts', [0] * len(counts))
+    history['counts'] = [a + b for a, b in zip(total_counts, counts)]
+    history['pulls'] = history.get('pulls', 0) + sum(counts)
+    if since_rare is None:
+        history['since_rare'] = history.get('since_rare', 0) + sum(counts)
+    else:
+        history['since_rare'] = since_rare
+    bot.user_settings.set_setting(user_id, GACHA_HISTORY_SETTING, history)
+    return history
+
+def format_gacha_counts(counts):
+    return " / ".join(f"{name}: {count}" for name, count in zip(GACHA_RARITY_NAMES, counts))
 
 async def send_gacha_results(message):
-    results = [perform_gacha_draw() for _ in range(9)]
-    results.append(perform_gacha_draw(guaranteed=True))
+    categories = gacha.pull_categories(10)
+    results = [gacha.pick(category) for category in categories]
+    record_gacha_history(message.author.id, *gacha.summarize(categories))
     await message.channel.send(f"{' '.join(results[0:5])}\n{' '.join(results[5:10])}")
 
 def get_random_shot():
     game = random.choice(SHOT_TYPE)
     return random.choice(game[1:])
 
+# -----------------------------------------------------------------------------
+# メッセージのトリガー判定
+# -----------------------------------------------------------------------------
+class TriggerMatcher:
+    """キーワードの表を1つの正規表現にまとめ，1回の走査で最優先のルールを求めるクラス
+
+    rules はキーワードのタプルを優先度の高い順に並べたもの．全キーワードを
+    トライ木の形の正規表現 (キャプチャグループ無し) にまとめることで，
+    re の先頭文字による絞り込みが効き，単純な `in` の連鎖より速く判定できる．
+    """
+
+    def __init__(self, rules):
+        rule_of = {}  # キーワード -> ルール番号
+        for index, keywords in enumerate(rules):
+            for keyword in keywords:
+                rule_of.setdefault(keyword, index)
+        # 正規表現は同じ位置から始まるキーワードのうち最も長いものを返すため，
+        # その接頭辞になっている (同時に一致している) キーワードの優先度も引き継ぐ
+        self._rule_of = {
+            keyword: min(rule_of[keyword[:n]] for n in range(1, len(keyword) + 1) if keyword[:n] in rule_of)
+            for keyword in rule_of
+        }
+        self._pattern = re.compile(self._trie_pattern(self._rule_of)) if self._rule_of else None
+
+    @classmethod
+    def _trie_pattern(cls, keywords):
+        trie = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[''] = True
+        return cls._node_pattern(trie)
+
+    @classmethod
+    def _node_pattern(cls, node):
+        branches = [re.escape(char) + cls._node_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            # ここで終わるキーワードもあるが，より長い一致を優先する
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+    def match(self, text):
+        """一致したルールのうち最も優先度の高いものの番号を返す．無ければNone
+
+        finditer は重なった一致を返さないため，一致した範囲の内側から始まる
+        キーワードも調べる (例: "pixiv.netwitter.com" の "twitter.com")．
+        """
+        if self._pattern is None:
+            return None
+        best = None
+        for keyword_match in self._pattern.finditer(text):
+            start, end = keyword_match.span()
+            for position in range(start, end):
+                found = keyword_match if position == start else self._pattern.match(text, position)
+                if found is None:
+                    continue
+                index = self._rule_of[found.group()]
+                if best is None or index < best:
+                    best = index
+                    if best == 0:
+                        return best
+        return best
+
+async def enqueue_media_link(message, url_type):
+    media_key = ('link', message.channel.id, message.author.id, media_link_key(message))
+    remote_job = {'kind': 'link', 'url_type': url_type, **remote_message_fields(message)}
+    await enqueue_media_job(message, media_key, lambda: process_media_link(message, url_type), remote_job)
+
+async def handle_twitter_link(message):
+    await enqueue_media_link(message, 'twitter')
+
+async def handle_pixiv_link(message):
+    await enqueue_media_link(message, 'pixiv')
+
+async def reply_random_shot(message):
+    await message.channel.send(get_random_shot())
+
+async def reply_nyan(message):
+    await message.channel.send("にゃ～ん")
+
+async def reply_help(message):
+    await message.channel.send("今日の機体、本日の機体 またはメンションで機体出します\n`!dm`で画像のDM送信をON/OFFに切り替えられます。\n`!gacha 回数`でガチャをまとめて引けます。")
+
+async def reply_source(message):
+    await message.channel.send("https://github.com/Kakeyouyou33554432/dis_test")
+
+async def reply_sticker(message):
+    await message.channel.send(random.choice(STICKER))
+
+# on_message で反応するキーワードの表．上にあるものほど優先される
+# (キーワード, 処理, メンションされたときにも反応するか)
+MESSAGE_TRIGGERS = (
+    (("x.com", "twitter.com"), handle_twitter_link, False),
+    (("pixiv.net",), handle_pixiv_link, False),
+    ((GACHA_TRIGGER,), send_gacha_results, False),
+    (("本日の機体", "今日の機体", "きょうのきたい", "ほんじつのきたい", "イッツルナティックターイム！"), reply_random_shot, True),
+    (("にゃ～ん", "にゃーん"), reply_nyan, False),
+    (("説明!", "せつめい!"), reply_help, False),
+    (("ソースコード", "そーす"), reply_source, False),
+    (("スタンプ", "すたんぷ"), reply_sticker, False),
+    (STICKER + ("💤",), reply_sticker, False),
+)
+MEDIA_LINK_TRIGGERS = (handle_twitter_link, handle_pixiv_link)
+MENTION_TRIGGER = next(index for index, (_, _, on_mention) in enumerate(MESSAGE_TRIGGERS) if on_mention)
+
+# 起動時に一度だけ表を正規表現へまとめておく
+message_trigger_matcher = TriggerMatcher([keywords for keywords, _, _ in MESSAGE_TRIGGERS])
+
+def match_message_trigger(message):
+    """メッセージに対応する MESSAGE_TRIGGERS の番号を返す．どれにも当たらなければNone"""
+    index = message_trigger_matcher.match(message.content)
+    if (index is None or index > MENTION_TRIGGER) and bot.user.mentioned_in(message):
+        index = MENTION_TRIGGER
+    return index
+
 # -----------------------------------------------------------------------------
 # Botコマンド
 # -----------------------------------------------------------------------------
@@ -298,15 +2215,38 @@ async def toggle_dm(ctx: commands.Context):
     user_id = str(ctx.author.id)
     current_setting = bot.user_settings.get(user_id, 'channel')
 
+    # 変更はストアが少し待ってからまとめてDBへ書き込む (終了時にも書き込まれる)
     if current_setting == 'channel':
         bot.user_settings[user_id] = 'dm'
         await ctx.send(f"{ctx.author.mention} 画像のDM送信を **ON** にしました．")
     else:
         bot.user_settings[user_id] = 'channel'
         await ctx.send(f"{ctx.author.mention} 画像のDM送信を **OFF** にしました．")
-    
-    # ★重要: 変更をファイルに保存する
-    save_user_settings(bot.user_settings)
+
+@bot.command(name="gacha")
+async def bulk_gacha(ctx: commands.Context, pulls: int = 10):
+    """ガチャをまとめて引き，レア度ごとの件数を表示します．"""
+    if not 1 <= pulls <= GACHA_MAX_PULLS:
+        await ctx.send(f"回数は 1 から {GACHA_MAX_PULLS} までで指定してください．")
+        return
+    counts, since_rare = gacha.bulk_pull(pulls)
+    history = record_gacha_history(ctx.author.id, counts, since_rare)
+    await ctx.send(
+        f"{ctx.author.mention} {pulls}連の結果\n{format_gacha_counts(counts)}\n"
+        f"最後の★3から {history['since_rare']} 回 (累計 {history['pulls']} 回)"
+    )
+
+@bot.command(name="gachastats")
+async def gacha_stats(ctx: commands.Context):
+    """これまでに引いたガチャの累計を表示します．"""
+    history = bot.user_settings.get_setting(ctx.author.id, GACHA_HISTORY_SETTING)
+    if not history:
+        await ctx.send(f"{ctx.author.mention} まだガチャを引いていません．")
+        return
+    await ctx.send(
+        f"{ctx.author.mention} 累計 {history['pulls']} 回\n{format_gacha_counts(history['counts'])}\n"
+        f"最後の★3から {history['since_rare']} 回"
+    )
 
 # -----------------------------------------------------------------------------
 # Discordイベントリスナー
@@ -315,7 +2255,16 @@ async def toggle_dm(ctx: commands.Context):
 async def on_message(message: discord.Message):
     """コマンド以外のメッセージを処理するリスナー"""
     if message.author == bot.user or message.author.bot:
+        bot.link_messages[message.id] = False
         return
+
+    # キーワードの判定は1回の走査で済ませる
+    trigger = match_message_trigger(message)
+
+    # リアクション保存時にREST APIを呼ばずに済むよう，対応リンクを含むかを記録しておく
+    # (リンクのルールは最優先なので，それ以外が選ばれた場合はリンクを含まない)
+    is_link_trigger = trigger is not None and MESSAGE_TRIGGERS[trigger][1] in MEDIA_LINK_TRIGGERS
+    bot.link_messages[message.id] = is_link_trigger and find_media_link(message.content) is not None
     
     # プレフィックス付きのコマンドはコマンドとして処理されるため，ここでは無視する
     if message.content.startswith(bot.command_prefix):
@@ -326,43 +2275,24 @@ async def on_message(message: discord.Message):
             try:
                 referenced_message = await message.channel.fetch_message(message.reference.message_id)
                 if referenced_message.embeds:
-                    asyncio.create_task(process_embed_images(message, referenced_message.embeds))
+                    image_url_groups = embed_image_url_groups(referenced_message.embeds)
+                    await enqueue_media_job(
+                        message,
+                        ('embed', message.channel.id, message.author.id, referenced_message.id),
+                        lambda: process_embed_images(message, image_url_groups),
+                        {'kind': 'embed', 'image_url_groups': image_url_groups, **remote_message_fields(message)},
+                    )
             except discord.NotFound:
                 await message.channel.send("返信元のメッセージが見つかりませんでした。", reference=message)
             except discord.Forbidden:
                 await message.channel.send("メッセージの読み取り権限がありません。", reference=message)
         return
 
-    if "x.com" in message.content or "twitter.com" in message.content:
-        asyncio.create_task(process_media_link(message, 'twitter'))
-        return
+    if trigger is not None:
+        _, handler, _ = MESSAGE_TRIGGERS[trigger]
+        await handler(message)
 
-    if "pixiv.net" in message.content:
-        asyncio.create_task(process_media_link(message, 'pixiv'))
-        return
-
-    if GACHA_TRIGGER in message.content:
-        await send_gacha_results(message)
-        return
-        
-    if (bot.user.mentioned_in(message) or any(keyword in message.content for keyword in ["本日の機体", "今日の機体", "きょうのきたい", "ほんじつのきたい", "イッツルナティックターイム！"])):
-        await message.channel.send(get_random_shot())
-        return
-    if any(keyword in message.content for keyword in ["にゃ～ん", "にゃーん"]):
-        await message.channel.send("にゃ～ん")
-        return
-    if any(keyword in message.content for keyword in ["説明!", "せつめい!"]):
-        await message.channel.send("今日の機体、本日の機体 またはメンションで機体出します\n`!dm`で画像のDM送信をON/OFFに切り替えられます。")
-        return
-    if any(keyword in message.content for keyword in ["ソースコード", "そーす"]):
-        await message.channel.send("https://github.com/Kakeyouyou33554432/dis_test")
-        return
-    if any(keyword in message.content for keyword in ["スタンプ", "すたんぷ"]):
-        await message.channel.send(random.choice(STICKER))
-        return
-    if any(s in message.content for s in STICKER) or "💤" in message.content:
-        await message.channel.send(random.choice(STICKER))
-        return
+REACTION_SAVE_EMOJIS = ('<:sikei:1404428286112825404>', '❤️')
 
 @bot.listen()
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
@@ -370,40 +2300,210 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     if payload.user_id == bot.user.id:
         return
 
-    target_emojis = ['<:sikei:1404428286112825404>', '❤️']
-    if str(payload.emoji) not in target_emojis:
+    if str(payload.emoji) not in REACTION_SAVE_EMOJIS:
         return
 
-    try:
-        channel = bot.get_channel(payload.channel_id)
-        if not isinstance(channel, discord.TextChannel):
-             return
-        message = await channel.fetch_message(payload.message_id)
-    except (discord.NotFound, discord.Forbidden):
+    # 対応リンクを含まないと分かっているメッセージや，同じユーザーが保存したばかりの
+    # メッセージへのリアクションはREST APIを呼ぶ前に捨てる
+    if bot.link_messages.get(payload.message_id) is False:
+        return
+    save_key = (payload.message_id, payload.user_id)
+    if save_key in bot.recent_reaction_saves:
         return
 
-    if message.author.bot:
+    channel = bot.get_channel(payload.channel_id)
+    if not isinstance(channel, discord.TextChannel):
         return
+    message = discord.utils.get(bot.cached_messages, id=payload.message_id)
+    if message is None:
+        try:
+            with metrics.time('reaction_fetch_message'):
+                message = await bot.reaction_messages.get_or_load(
+                    payload.message_id, lambda: channel.fetch_message(payload.message_id)
+                )
+        except (discord.NotFound, discord.Forbidden):
+            return
 
-    try:
-        user = await bot.fetch_user(payload.user_id)
-    except discord.NotFound:
+    has_link = not message.author.bot and find_media_link(message.content) is not None
+    bot.link_messages[message.id] = has_link
+    if not has_link:
         return
 
-    image_url_groups, original_url = await get_image_urls_from_message(message.content)
+    user = payload.member or bot.get_user(payload.user_id)
+    if user is None:
+        try:
+            user = await bot.fetch_user(payload.user_id)
+        except discord.NotFound:
+            return
+
+    bot.recent_reaction_saves[save_key] = True
+    remote_job = {
+        'kind': 'reaction', 'channel_id': channel.id, 'user_id': user.id,
+        'message_id': message.id, 'content': message.content,
+    }
+    await run_media_job(remote_job, lambda: save_reaction_images(channel, user, message.id, message.content))
 
-    if image_url_groups:
-        print(f"Processing reaction save for {user.name} on message {message.id}")
-        await download_and_send_images(user, image_url_groups, channel, user, original_url=original_url)
+@bot.listen()
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    """編集でリンクが増減する場合があるため，記録済みの情報を捨てる"""
+    bot.link_messages.pop(payload.message_id)
+    bot.reaction_messages.invalidate(payload.message_id)
     
+# -----------------------------------------------------------------------------
+# メディアワーカー (Gatewayに接続せず，REST APIだけでメディアのジョブを処理する)
+# -----------------------------------------------------------------------------
+# DMの送信先ユーザーの問い合わせ結果を使い回す件数と時間 (秒)
+REMOTE_USER_CACHE_SIZE = 1024
+REMOTE_USER_CACHE_TTL = 600
+
+class RemoteMessage:
+    """ワーカープロセスで，Gatewayプロセスから受け取ったメッセージの代わりに使うオブジェクト
+
+    処理に必要な本文と投稿者だけを持ち，リアクションと返信先の指定は
+    REST APIで操作できる PartialMessage に任せる．
+    """
+
+    def __init__(self, partial_message, content, author):
+        self._partial_message = partial_message
+        self.id = partial_message.id
+        self.channel = partial_message.channel
+        self.guild = None
+        self.content = content
+        self.author = author
+
+    async def add_reaction(self, emoji):
+        await self._partial_message.add_reaction(emoji)
+
+    async def remove_reaction(self, emoji, member):
+        await self._partial_message.remove_reaction(emoji, member)
+
+    def to_message_reference_dict(self):
+        return self._partial_message.to_message_reference_dict()
+
+async def fetch_remote_user(user_id):
+    """DMの送信先のユーザーを取得する (同じユーザーへの問い合わせはまとめる)"""
+    return await bot.remote_users.get_or_load(user_id, lambda: bot.fetch_user(user_id))
+
+async def run_remote_job(job):
+    """Gatewayプロセスから受け取ったジョブを実行する"""
+    channel = bot.get_partial_messageable(job['channel_id'])
+    if job['kind'] == 'reaction':
+        user = await fetch_remote_user(job['user_id'])
+        await save_reaction_images(channel, user, job['message_id'], job['content'])
+        return
+
+    send_preference = job['send_preference']
+    # 投稿者のユーザー情報が必要なのはDMへ送る場合だけ
+    if send_preference == 'dm':
+        author = await fetch_remote_user(job['author_id'])
+    else:
+        author = discord.Object(job['author_id'])
+    message = RemoteMessage(channel.get_partial_message(job['message_id']), job['content'], author)
+    if job['kind'] == 'link':
+        await process_media_link(message, job['url_type'], send_preference)
+    elif job['kind'] == 'embed':
+        await process_embed_images(message, job['image_url_groups'], send_preference)
+    else:
+        raise ValueError(f"Unknown media job kind: {job['kind']}")
+
+async def connect_to_gateway_process(socket_path):
+    """Gatewayプロセスのソケットへ接続して名乗る (起動を待つため一定時間は接続し直す)"""
+    deadline = time.monotonic() + MEDIA_WORKER_CONNECT_TIMEOUT
+    while True:
+        try:
+            # 他のユーザーが先に作ったソケットから，偽のジョブを受け取らないようにする
+            if os.stat(socket_path).st_uid != os.getuid():
+                raise RuntimeError(f"{socket_path} は別のユーザーが作成したソケットのため接続しません．")
+            reader, writer = await asyncio.open_unix_connection(socket_path, limit=MEDIA_IPC_LINE_LIMIT)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() >= deadline:
+                raise
+            await asyncio.sleep(0.5)
+    writer.write(json.dumps({'hello': MEDIA_WORKER_HELLO, 'pid': os.getpid()}).encode('utf-8') + b'\n')
+    await writer.drain()
+    return reader, writer
+
+async def serve_media_jobs(reader, writer):
+    """接続が切れるまでジョブを受け取って並行して実行し，それぞれの結果を返す"""
+    tasks = set()
+
+    async def run_job(job):
+        reply = {'id': job['id'], 'ok': True}
+        try:
+            await run_remote_job(job)
+        except Exception as e:
+            print(f"Media job {job['kind']} failed: {e}")
+            traceback.print_exc()
+            reply.update(ok=False, error=f"{type(e).__name__}: {e}")
+        writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+
+    while line := await reader.readline():
+        task = asyncio.create_task(run_job(json.loads(line)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    # Gatewayプロセスが終了した．受け取り済みのジョブだけ終えてから止まる
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def run_media_worker(token, socket_path=MEDIA_IPC_SOCKET, index=0):
+    """ワーカーとしてログインし，Gatewayプロセスから届くジョブを処理する"""
+    bot.run_mode = 'worker'
+    bot.remote_users = AsyncTTLCache(REMOTE_USER_CACHE_SIZE, REMOTE_USER_CACHE_TTL, RESOLVE_CACHE_NEGATIVE_TTL)
+    if IMAGE_CACHE_DIR:
+        # 同じディレクトリを複数のプロセスで使わないよう，ワーカーごとに分ける
+        bot.image_cache = ImageCache(
+            IMAGE_CACHE_MEMORY_BYTES, os.path.join(IMAGE_CACHE_DIR, f"worker{index}"), IMAGE_CACHE_DISK_BYTES
+        )
+    async with bot:
+        # login() はGatewayに接続せず，REST API用の認証と setup_hook だけを行う
+        await bot.login(token)
+        reader, writer = await connect_to_gateway_process(socket_path)
+        print(f"--- ⚙️ Media worker {index} is ready (pid {os.getpid()}) ---")
+        try:
+            await serve_media_jobs(reader, writer)
+        finally:
+            writer.close()
+
+def media_worker_process_main(index, socket_path):
+    """gateway モードで起動されるワーカープロセスの入口"""
+    # Ctrl+C はGatewayプロセスに任せる．Gatewayがソケットを閉じると，受け取り済みのジョブを終えてから止まる
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    discord.utils.setup_logging()
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(run_media_worker(os.environ["DISCORD_BOT_TOKEN"], socket_path, index))
+
 # -----------------------------------------------------------------------------
 # 統合起動処理
 # -----------------------------------------------------------------------------
 @bot.event
 async def setup_hook():
     """BotがDiscordにログインする前に一度だけ実行される"""
+    if bot.run_mode == 'worker':
+        # ワーカーは画像の取得と送信だけを行う (設定DBやWebサーバーはGatewayプロセスが持つ)
+        await bot.http_pool.start()
+        return
+
     # 永続Viewを登録
     bot.add_view(DeleteButtonView())
+
+    # ユーザー設定をDBから読み込む
+    await bot.user_settings.load()
+
+    # 外部API/画像取得用のコネクションプールを開始
+    await bot.http_pool.start()
+
+    # リンク処理のワーカーを起動
+    bot.media_jobs.start()
+
+    # gateway モードではジョブを受け渡すソケットを開き，ワーカープロセスを起動する
+    if bot.media_workers is not None:
+        await bot.media_workers.start()
+        print(f"--- ⚙️ Media worker socket is listening on {bot.media_workers.socket_path} ---")
+
+    # イベントループの遅延計測とメトリクスの定期収集を開始
+    bot.lag_sampler = asyncio.create_task(sample_event_loop_lag())
     
     # Webサーバーをバックグラウンドタスクとして起動
     port = int(os.environ.get("PORT", 8080))
@@ -411,9 +2511,21 @@ async def setup_hook():
     config.bind = [f"0.0.0.0:{port}"]
     
     # Botのイベントループ上でWebサーバーを協調動作させる
-    bot.loop.create_task(serve(app, config))
+    # (shutdown_trigger を渡さないとhypercornがSIGINT/SIGTERMを横取りし，Webサーバーだけが止まる)
+    bot.web_server = asyncio.create_task(serve(app, config, shutdown_trigger=bot.web_shutdown.wait))
     print(f"--- 🌐 Hypercorn web server is running on port {port} ---")
 
+    # Renderの停止 (SIGTERM) やCtrl+Cでも，キューの処理待ちと設定の書き込みを済ませてから終了する
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, request_shutdown)
+
+def request_shutdown():
+    """シグナルを受けたらBotの終了処理を始める (2回目以降のシグナルは無視する)"""
+    if bot.shutdown_task is None:
+        print("--- 🛑 Shutting down ---")
+        bot.shutdown_task = asyncio.create_task(bot.close())
+
 @bot.event
 async def on_ready():
     """Botの準備が完了したときのイベント"""
@@ -424,11 +2536,31 @@ async def on_ready():
 # -----------------------------------------------------------------------------
 # メインの実行ブロック
 # -----------------------------------------------------------------------------
-if __name__ == "__main__":
+def start(argv):
+    """コマンドライン引数に従ってBotかワーカーを起動する (run.py から呼ばれる)"""
+    # 実行モードは引数 (python run.py gateway など) か環境変数 RUN_MODE で指定する
+    run_mode = argv[0] if argv else RUN_MODE
     bot_token = os.environ.get("DISCORD_BOT_TOKEN")
-    if not bot_token:
+    if run_mode not in RUN_MODES:
+        print(f"不明な実行モードです: {run_mode} ({' / '.join(RUN_MODES)} のいずれかを指定してください)")
+    elif not bot_token:
         print("環境変数 DISCORD_BOT_TOKEN が設定されていません．")
+    elif SHARD_CONFIG_ERROR and run_mode != 'worker':
+        print(SHARD_CONFIG_ERROR)
+    elif run_mode == 'worker':
+        # Gatewayプロセスとは別に起動するワーカー (python run.py worker <番号>)．
+        # この場合Gateway側は MEDIA_WORKER_PROCESSES=0 にして自前のワーカーを起動しない
+        discord.utils.setup_logging()
+        worker_index = int(argv[1]) if len(argv) > 1 else 0
+        with contextlib.suppress(KeyboardInterrupt):
+            asyncio.run(run_media_worker(bot_token, MEDIA_IPC_SOCKET, worker_index))
     else:
+        bot.run_mode = run_mode
+        if run_mode == 'gateway':
+            bot.media_workers = MediaWorkerPool()
         # bot.run() を呼び出すと，setup_hook -> on_ready の順で実行される
         bot.run(bot_token)
 
+if __name__ == "__main__":
+    # 直接実行しても動くが，spawn で起動する子プロセスがこのファイル全体を読み込み直すため run.py から起動する
+    start(sys.argv[1:])
@@ -0,0 +1,14 @@
+"""Botの起動スクリプト (python run.py [実行モード] [ワーカー番号])
+
+spawn で起動する子プロセス (画像の縮小プールとメディアワーカー) は，親の起動スクリプトを
+__mp_main__ として読み込み直す．main.py を直接実行するとそれが main.py 全体になり，
+子プロセスごとに discord.py や Flask を読み込んでBotやキャッシュを作ってしまう．
+このスクリプトは main を __main__ ブロックの中でだけ読み込むため，縮小プールの子プロセスは
+image_transcode だけを，メディアワーカーは main だけを読み込む．
+"""
+import sys
+
+if __name__ == "__main__":
+    import main
+
+    main.start(sys.argv[1:])